@@ -85,39 +85,70 @@ class WeightedGradebook(object):
 # 入れ子が二段以上になり複雑になるならクラスに分割する
 # まず依存性ツリーの最下部にある個々の成績からクラス化する
 import collections
+import functools
+import itertools
+import operator
 Grade = collections.namedtuple('Grade', ('score', 'weight'))
 
 # 科目のクラス化
+# 重みつきの合計と重みの合計をreport_gradeのたびに足しておけば、
+# average_gradeは成績の数によらずO(1)になる。足す順番は全部を足し直すときと
+# 同じなので、結果の浮動小数点数も変わらない
 class Subject(object):
-    def __init__(self):
+    def __init__(self, on_change=None):
         self._grades = []
+        self._total = 0
+        self._total_weight = 0
+        self._on_change = on_change # 成績が増えたときに呼ぶ
     
     def report_grade(self, score, weight):
         self._grades.append(Grade(score, weight))
+        self._total += score * weight
+        self._total_weight += weight
+        if self._on_change is not None:
+            self._on_change()
+
+    def report_grades(self, scores, weights):
+        """同じ長さのscoresとweightsをまとめて記録する。合計は
+        report_gradeと同じ順番で足す(sumは3.12から足し方が変わる)
+        """
+        # Grade(score, weight)を1件ずつ呼ばずに、Cの中でタプルを作る
+        self._grades.extend(
+            map(tuple.__new__, itertools.repeat(Grade), zip(scores, weights)))
+        self._total = functools.reduce(
+            operator.add, map(operator.mul, scores, weights), self._total)
+        self._total_weight = functools.reduce(
+            operator.add, weights, self._total_weight)
+        if self._on_change is not None:
+            self._on_change()
     
     def average_grade(self):
-        total, total_weight = 0, 0
-        for grade in self._grades:
-            total += grade.score * grade.weight
-            total_weight += grade.weight
-        return total / total_weight
+        return self._total / self._total_weight
 
 # 学生が勉強している科目のクラス化
+# 平均は覚えておき、どれかの科目に成績が増えたときだけ計算し直す
 class Student(object):
     def __init__(self):
         self._subjects = {}
+        self._average = None
     
     def subject(self, name):
         if name not in self._subjects:
-            self._subjects[name] = Subject()
+            self._subjects[name] = Subject(on_change=self._invalidate)
+            self._average = None
         return self._subjects[name]
+
+    def _invalidate(self):
+        self._average = None
     
     def average_grade(self):
-        total, count = 0, 0
-        for subject in self._subjects.values():
-            total += subject.average_grade()
-            count += 1
-        return total / count
+        if self._average is None:
+            total, count = 0, 0
+            for subject in self._subjects.values():
+                total += subject.average_grade()
+                count += 1
+            self._average = total / count
+        return self._average
 
 # 学生のコンテナ
 class Gradebook(object):
@@ -139,4 +170,371 @@ print(molpako.average_grade())
 
 # 値がほかの辞書や長いタプルであるような辞書はつくらない
 # 完全なクラスの柔軟性が必要となる前は軽量でミュータブルな namedtuple を使う
-# 内部状態辞書が複雑になったら記録管理コードを複数のヘルパークラスを使うように変更する
\ No newline at end of file
+# 内部状態辞書が複雑になったら記録管理コードを複数のヘルパークラスを使うように変更する
+
+# 成績が何千万件にもなると、Gradeのnamedtupleを1件ずつリストに入れるのは
+# メモリを食いすぎる。ColumnarGradebookは科目ごとに学生の番号、点数、重みを
+# arrayの列に詰めて持つ。学生と科目の名前は番号に置き換えて1回だけ覚える。
+# 点数と重みは取りうる値が少ないので、値そのものではなく値の表の番号を入れる。
+# 値がほとんど重ならないなら表が大きくなるだけなので向かない。
+# 列はarray('B')から始め、番号が入りきらなくなったら'H'、'I'と広げる。
+# student(name).subject(name).report_grade(score, weight)はそのまま使え、
+# 平均はSubjectと同じ順番で足した合計から求めるので結果も同じ。
+# 科目全体の平均と上位N人は学生ごとの合計から、パーセンタイルは点数の番号を
+# 数えてから計算する。numpyは使わず、標準ライブラリだけで動く
+from array import array
+import bisect
+import heapq
+
+_WIDER_TYPECODES = {'B': 'H', 'H': 'I', 'I': 'Q'}
+
+def _extend_column(columns, index, values):
+    """columns[index]にvaluesを足す。入りきらなければ広い型に置き換える"""
+    column = columns[index]
+    size = len(column)
+    while True:
+        try:
+            column.extend(values)
+            return
+        except OverflowError:
+            del column[size:]
+            column = columns[index] = array(
+                _WIDER_TYPECODES[column.typecode], column)
+
+class ColumnarGradebook(object):
+    def __init__(self):
+        self._student_ids = {}
+        self._student_names = []
+        self._subject_ids = {}
+        self._subject_names = []
+        self._value_ids = {} # 点数や重み -> 値の表の番号
+        self._values = [] # 値の表の番号 -> 点数や重み
+        self._columns = [] # 科目番号 -> [学生番号, 点数の番号, 重みの番号]の列
+        self._totals = [] # 学生番号 -> {科目番号: [重みつき合計, 重みの合計]}
+        self._averages = [] # 学生番号 -> 平均。Noneなら計算し直す
+
+    def _intern_student(self, name):
+        student_id = self._student_ids.get(name)
+        if student_id is None:
+            student_id = self._student_ids[name] = len(self._student_names)
+            self._student_names.append(name)
+            self._totals.append({})
+            self._averages.append(None)
+        return student_id
+
+    def _intern_subject(self, name):
+        subject_id = self._subject_ids.get(name)
+        if subject_id is None:
+            subject_id = self._subject_ids[name] = len(self._subject_names)
+            self._subject_names.append(name)
+            self._columns.append([array('B'), array('B'), array('B')])
+        return subject_id
+
+    def _intern_value(self, value):
+        value_id = self._value_ids.get(value)
+        if value_id is None:
+            value_id = self._value_ids[value] = len(self._values)
+            self._values.append(value)
+        return value_id
+
+    def _intern_values(self, values):
+        value_ids = list(map(self._value_ids.get, values))
+        if None in value_ids:
+            value_ids = list(map(self._intern_value, values))
+        return value_ids
+
+    def student(self, name):
+        return ColumnarStudent(self, self._intern_student(name))
+
+    def _report_grade(self, student_id, subject_id, score, weight):
+        columns = self._columns[subject_id]
+        row = (student_id, self._intern_value(score),
+               self._intern_value(weight))
+        size = len(columns[0])
+        try:
+            for column, value in zip(columns, row):
+                column.append(value)
+        except OverflowError: # 途中まで足した列を戻して広げる
+            for index, value in enumerate(row):
+                del columns[index][size:]
+                _extend_column(columns, index, (value,))
+        totals = self._totals[student_id][subject_id]
+        totals[0] += score * weight
+        totals[1] += weight
+        self._averages[student_id] = None
+
+    def _report_grades(self, student_id, subject_id, scores, weights):
+        columns = self._columns[subject_id]
+        _extend_column(columns, 0, [student_id] * len(scores))
+        _extend_column(columns, 1, self._intern_values(scores))
+        _extend_column(columns, 2, self._intern_values(weights))
+        totals = self._totals[student_id][subject_id]
+        totals[0] = functools.reduce(
+            operator.add, map(operator.mul, scores, weights), totals[0])
+        totals[1] = functools.reduce(operator.add, weights, totals[1])
+        self._averages[student_id] = None
+
+    def _student_average(self, student_id):
+        average = self._averages[student_id]
+        if average is None:
+            total, count = 0, 0
+            for subject_total, total_weight in self._totals[student_id].values():
+                total += subject_total / total_weight
+                count += 1
+            average = self._averages[student_id] = total / count
+        return average
+
+    def __len__(self):
+        return sum(len(scores) for _, scores, _ in self._columns)
+
+    def nbytes(self):
+        """列が使っているバイト数"""
+        return sum(column.itemsize * len(column)
+                   for columns in self._columns for column in columns)
+
+    def subject_mean(self, subject):
+        """科目のすべての成績の重みつき平均。学生ごとの合計を足すだけでよい"""
+        subject_id = self._subject_ids[subject]
+        total = total_weight = 0
+        for totals in self._totals:
+            subject_totals = totals.get(subject_id)
+            if subject_totals is not None:
+                total += subject_totals[0]
+                total_weight += subject_totals[1]
+        return total / total_weight
+
+    def subject_percentile(self, subject, percent):
+        """科目の点数のpercentパーセンタイル。間は線形補間する"""
+        _, scores, _ = self._columns[self._subject_ids[subject]]
+        counts = sorted((self._values[score], count)
+                        for score, count in collections.Counter(scores).items())
+        # 件数を足していき、小さいほうからi番目の点数がどこにあるかを二分探索する
+        ends = list(itertools.accumulate(count for _, count in counts))
+        def nth(i):
+            return counts[bisect.bisect_right(ends, i)][0]
+        position = (len(scores) - 1) * percent / 100
+        lower = int(position)
+        upper = min(lower + 1, len(scores) - 1)
+        return nth(lower) + (nth(upper) - nth(lower)) * (position - lower)
+
+    def top_students(self, subject, n=10):
+        """科目の平均が高い順にn人の(名前, 平均)のリスト"""
+        subject_id = self._subject_ids[subject]
+        averages = ((totals[subject_id][0] / totals[subject_id][1], student_id)
+                    for student_id, totals in enumerate(self._totals)
+                    if totals.get(subject_id, (0, 0))[1])
+        return [(self._student_names[student_id], average)
+                for average, student_id in heapq.nlargest(
+                    n, averages, key=lambda item: item[0])]
+
+class ColumnarStudent(object):
+    """ColumnarGradebookの中の1人の学生。番号しか持たない"""
+    def __init__(self, book, student_id):
+        self._book = book
+        self._student_id = student_id
+
+    def subject(self, name):
+        book = self._book
+        subject_id = book._intern_subject(name)
+        totals = book._totals[self._student_id]
+        if subject_id not in totals:
+            totals[subject_id] = [0, 0]
+            book._averages[self._student_id] = None
+        return ColumnarSubject(book, self._student_id, subject_id)
+
+    def average_grade(self):
+        return self._book._student_average(self._student_id)
+
+
+class ColumnarSubject(object):
+    """ColumnarGradebookの中の1人の学生の1科目"""
+    def __init__(self, book, student_id, subject_id):
+        self._book = book
+        self._student_id = student_id
+        self._subject_id = subject_id
+
+    def report_grade(self, score, weight):
+        self._book._report_grade(self._student_id, self._subject_id,
+                                 score, weight)
+
+    def report_grades(self, scores, weights):
+        self._book._report_grades(self._student_id, self._subject_id,
+                                  scores, weights)
+
+    def average_grade(self):
+        total, total_weight = self._book._totals[self._student_id][
+            self._subject_id]
+        return total / total_weight
+
+
+book = ColumnarGradebook()
+molpako = book.student('molpako')
+math = molpako.subject('Math')
+math.report_grade(80, 0.10)
+math.report_grade(90, 0.10)
+math.report_grade(10, 0.80)
+print(molpako.average_grade())
+
+# Gradebookと同じ成績を入れて、結果とメモリの量を比べる
+import random
+import tracemalloc
+from time import perf_counter
+
+random.seed(1)
+records = [('student%d' % random.randrange(2000),
+            random.choice(('Math', 'Gym', 'Music', 'Art')),
+            random.randrange(101), random.choice((0.1, 0.2, 0.3)))
+           for _ in range(2 * 10**5)]
+sizes = {}
+for book_cls in (Gradebook, ColumnarGradebook):
+    tracemalloc.start()
+    book = book_cls()
+    for name, subject, score, weight in records:
+        book.student(name).subject(subject).report_grade(score, weight)
+    sizes[book_cls] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%-17s: %5.1f bytes per grade' % (
+        book_cls.__name__, sizes[book_cls] / len(records)))
+    if book_cls is Gradebook:
+        row_book = book
+assert all(row_book.student(name).average_grade() ==
+           book.student(name).average_grade()
+           for name in row_book._students)
+
+start = perf_counter()
+mean = book.subject_mean('Math')
+median = book.subject_percentile('Math', 50)
+top = book.top_students('Math', 3)
+end = perf_counter()
+print('columns %.1f bytes per grade' % (book.nbytes() / len(book)))
+print('mean %.2f, median %.1f, top %s in %.3f seconds' % (
+    mean, median, top[0], end - start))
+# > Gradebook        :  87.0 bytes per grade
+# > ColumnarGradebook:  12.0 bytes per grade
+# > columns 4.0 bytes per grade
+# > mean 49.94, median 50.0, top ('student928', 74.74999999999999) in 0.003 seconds
+# 列は1件4バイト(学生番号2 + 点数の番号1 + 重みの番号1)で、残りは学生ごとの
+# 合計の辞書。2万人に500万件入れると全体で1件8.7バイトだったので、5000万件でも
+# 列は約200MB、全体で数百MBに収まる。そのとき1科目125万件の平均と上位3人は
+# 学生の数に比例するので約3ミリ秒だが、パーセンタイルは点数の番号を1件ずつ
+# 数えるので約0.05秒かかり、件数に比例して増える
+
+
+# 1件ずつreport_gradeを呼ぶと、1件ごとに辞書を3回引いてメソッドを3回呼ぶ。
+# bulk_ingestは成績を(学生, 科目)ごとに点数と重みのarrayにため、
+# batch_size件たまったら組ごとに1回のreport_gradesで追加する。並び順に
+# よらずまとめられ、ColumnarGradebookは列にまとめてextendする。
+# 平均は組ごとに読んだ順に足すので1件ずつ入れたときと同じになる。
+# 列の中の順番は組ごとにまとまるので、科目全体の集計は最後の桁が変わりうる。
+# CSVのパスを渡すと1行ずつ読むので、メモリに入らない大きさでもよい
+import csv
+import os
+
+IngestStats = collections.namedtuple(
+    'IngestStats', ('rows', 'batches', 'seconds', 'rows_per_second'))
+
+def iter_csv_grades(path):
+    """student,subject,score,weightの見出しがあるCSVから成績を1件ずつ返す。
+    列の順番は見出しで決まる
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        indexes = [header.index(field)
+                   for field in ('student', 'subject', 'score', 'weight')]
+        get_fields = operator.itemgetter(*indexes)
+        for row in reader:
+            name, subject, score, weight = get_fields(row)
+            yield name, subject, float(score), float(weight)
+
+def bulk_ingest(book, records, batch_size=100000):
+    """records((学生, 科目, 点数, 重み)のイテラブルかCSVのパス)をbookに入れる。
+    GradebookでもColumnarGradebookでもよい。(学生, 科目)ごとに点数と重みを
+    arrayにため、batch_size件たまるごとに組ごとのreport_gradesで追加する
+    """
+    if isinstance(records, (str, os.PathLike)):
+        records = iter_csv_grades(records)
+    subjects = {} # (学生, 科目) -> Subject。引き直さないように覚えておく
+    pending = {} # (学生, 科目) -> (点数のarray, 重みのarray)
+    rows = batches = 0
+
+    def flush():
+        # pendingは組が初めて出てきた順なので、学生の科目も1件ずつ入れたときと
+        # 同じ順番で作られる。学生の平均は科目を作った順に足すので同じになる
+        for key, (scores, weights) in pending.items():
+            target = subjects.get(key)
+            if target is None:
+                target = subjects[key] = book.student(key[0]).subject(key[1])
+            if len(scores) == 1: # 1件だけならreport_gradeのほうが速い
+                target.report_grade(scores[0], weights[0])
+            else:
+                target.report_grades(scores, weights)
+        count = len(pending)
+        pending.clear()
+        return count
+
+    start = perf_counter()
+    for name, subject, score, weight in records:
+        key = (name, subject)
+        buffers = pending.get(key)
+        if buffers is None:
+            buffers = pending[key] = (array('d'), array('d'))
+        buffers[0].append(score)
+        buffers[1].append(weight)
+        rows += 1
+        if rows % batch_size == 0:
+            batches += flush()
+    batches += flush()
+    seconds = perf_counter() - start
+    return IngestStats(rows, batches, seconds,
+                       rows / seconds if seconds else 0.0)
+
+import tempfile
+with tempfile.TemporaryDirectory() as tmp:
+    paths = {}
+    for order, rows in (('shuffled', records),
+                        ('by student', sorted(records, key=lambda r: r[:2]))):
+        paths[order] = os.path.join(tmp, '%s.csv' % order.replace(' ', '_'))
+        with open(paths[order], 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('student', 'subject', 'score', 'weight'))
+            writer.writerows(rows)
+
+    sources = dict(paths, **{'in memory': records}) # CSVを読まずに比べる
+    for book_cls in (Gradebook, ColumnarGradebook):
+        for order, source in sources.items():
+            if source is records:
+                grades = records
+            else:
+                grades = iter_csv_grades(source)
+            book = book_cls()
+            start = perf_counter()
+            for name, subject, score, weight in grades:
+                book.student(name).subject(subject).report_grade(score, weight)
+            seconds = perf_counter() - start
+            expected = {name: book.student(name).average_grade()
+                        for name, _, _, _ in records[:1000]}
+            del book
+            book = book_cls()
+            stats = bulk_ingest(book, source)
+            print('%-17s %-10s: report_grade %7.0f rows/s, '
+                  'bulk_ingest %7.0f rows/s' % (
+                book_cls.__name__, order, len(records) / seconds,
+                stats.rows_per_second))
+            assert all(book.student(name).average_grade() == average
+                       for name, average in expected.items())
+            del book
+# > Gradebook         shuffled  : report_grade  308557 rows/s, bulk_ingest  252748 rows/s
+# > Gradebook         by student: report_grade  321701 rows/s, bulk_ingest  346542 rows/s
+# > Gradebook         in memory : report_grade  416483 rows/s, bulk_ingest  409007 rows/s
+# > ColumnarGradebook shuffled  : report_grade  339725 rows/s, bulk_ingest  318220 rows/s
+# > ColumnarGradebook by student: report_grade  369530 rows/s, bulk_ingest  577022 rows/s
+# > ColumnarGradebook in memory : report_grade  417932 rows/s, bulk_ingest  782682 rows/s
+# ColumnarGradebookでは、CSVを読まなければ並び順によらず約1.8倍になる。
+# 1件ずつのreport_gradeは点数と重みを値の表の番号に置き換えるぶん遅くなり、
+# Gradebookとほぼ同じになる。
+# shuffledのCSVでは、行ごとにCSVを読んで新しい文字列のハッシュを求める時間が
+# 大半で差がでない。Gradebookはまとめても1件ごとにGradeのタプルを作るので
+# ほとんど変わらない。計測のたびに1割ほどぶれる
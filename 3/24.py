@@ -5,7 +5,78 @@ class InputData(object):
     def read(self):
         raise NotImplementedError
 
-class PathInputData(InputData):
+# read()はファイル全体をデコードしたstrにするので、改行を数えるだけでも
+# ファイルサイズの何倍ものメモリとデコードのコストがかかる。
+# pathをもつ入力にバイナリのチャンク読み込みを追加するmix-inを用意する
+import asyncio
+import codecs
+import os
+from time import perf_counter
+class ChunkedReadMixin(object):
+    """self.pathのファイルを固定サイズのチャンクで読み出すmix-in。
+    startとendでファイルの一部のバイト範囲だけを読むこともできる
+    """
+    chunk_size = 1024 * 1024
+    start = 0
+    end = None
+    bytes_read = 0
+    read_seconds = 0.0
+
+    def iter_chunks(self, chunk_size=None, encoding=None):
+        """chunk_sizeバイトずつbytesを返すジェネレータ。メモリ使用量は
+        ファイルサイズによらず一定。テキストが必要なWorkerはencodingを
+        指定すると、チャンクの境界で文字が切れないようにデコードしたstrになる
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        chunks = self._count_chunks(self.iter_raw_chunks(chunk_size))
+        if encoding is None:
+            yield from chunks
+            return
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for chunk in chunks:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def _count_chunks(self, chunks):
+        """読み込んだバイト数と読み込みにかかった時間を記録する"""
+        while True:
+            begin = perf_counter()
+            chunk = next(chunks, None)
+            self.read_seconds += perf_counter() - begin
+            if chunk is None:
+                return
+            self.bytes_read += len(chunk)
+            yield chunk
+
+    def iter_raw_chunks(self, chunk_size):
+        """空でないbytesのチャンクを返す。ファイル以外から読む
+        サブクラスはこれをオーバーライドする
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.start)
+            remaining = None if self.end is None else self.end - self.start
+            while True:
+                if remaining is None:
+                    chunk = f.read(chunk_size)
+                else:
+                    chunk = f.read(min(chunk_size, remaining))
+                    remaining -= len(chunk)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def aload(self, http_pool):
+        """async_mapreduce()でmapに渡す入力を返す。デフォルトはここでは
+        読まずにselfを返し、mapの中でiter_chunks()で少しずつ読ませる
+        """
+        return self
+
+class PathInputData(ChunkedReadMixin, InputData):
     """データをディスクのファイルから読み込む"""
     def __init__(self, path):
         super().__init__()
@@ -14,9 +85,248 @@ class PathInputData(InputData):
     def read(self):
         return open(self.path).read()
 
-class NetworkInputData(InputData):
+# ネットワークからの入力はHTTPで読み込む。同じホストへの接続は使い回す
+import http.client
+import threading
+from urllib.parse import urlsplit
+class HTTPConnectionPool(object):
+    """ホストごとにhttp.clientの接続を保持して再利用するプール"""
+    def __init__(self, max_idle=10, timeout=30):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.pid = os.getpid()
+
+    def _connect(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _take(self, key):
+        with self.lock:
+            if self.pid != os.getpid():
+                # fork した子プロセスでは親のソケットを使わない
+                self.idle, self.pid = {}, os.getpid()
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(), True
+        return self._connect(key), False
+
+    def _give(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def _request(self, key, target):
+        connection, reused = self._take(key)
+        try:
+            connection.request('GET', target)
+            return connection, connection.getresponse()
+        except ConnectionError:
+            # 使い回した接続がサーバに切られていたら1回だけつなぎ直す
+            connection.close()
+            if not reused:
+                raise
+        connection = self._connect(key)
+        connection.request('GET', target)
+        return connection, connection.getresponse()
+
+    def get(self, url, chunk_size):
+        """urlをGETして本文をchunk_sizeバイトずつ返すジェネレータ"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        connection, response = self._request(key, target)
+        try:
+            if response.status != 200:
+                raise OSError('GET %s failed: %d %s' % (
+                    url, response.status, response.reason))
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._give(key, connection)
+
+class AsyncHTTPConnectionPool(object):
+    """asyncioのストリームでHTTP/1.1のGETを行い、接続を再利用するプール。
+    1つのイベントループの中だけで使う
+    """
+    def __init__(self, max_idle=100):
+        self.max_idle = max_idle
+        self.idle = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle = {}
+
+    async def _take(self, parts, fresh=False):
+        key = (parts.scheme, parts.hostname, parts.port)
+        connections = self.idle.get(key)
+        if connections and not fresh:
+            return key, connections.pop(), True
+        default_port = 443 if parts.scheme == 'https' else 80
+        connection = await asyncio.open_connection(
+            parts.hostname, parts.port or default_port,
+            ssl=parts.scheme == 'https' or None)
+        return key, connection, False
+
+    def _give(self, key, connection):
+        connections = self.idle.setdefault(key, [])
+        if len(connections) < self.max_idle:
+            connections.append(connection)
+        else:
+            connection[1].close()
+
+    async def get(self, url, max_size=None):
+        """urlをGETして本文をbytesで返す。max_sizeを超える本文はOSErrorにする"""
+        parts = urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        key, connection, reused = await self._take(parts)
+        try:
+            body, keep_alive = await self._fetch(
+                connection, parts, target, max_size)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            connection[1].close()
+            if not reused:
+                raise
+            # 使い回した接続がサーバに切られていたら1回だけつなぎ直す
+            key, connection, _ = await self._take(parts, fresh=True)
+            body, keep_alive = await self._fetch(
+                connection, parts, target, max_size)
+        except BaseException:
+            connection[1].close()
+            raise
+        if keep_alive:
+            self._give(key, connection)
+        else:
+            connection[1].close()
+        return body
+
+    @staticmethod
+    async def _fetch(connection, parts, target, max_size):
+        def check_size(size):
+            if max_size is not None and size > max_size:
+                raise OSError('GET %s failed: body exceeds %d bytes' % (
+                    parts.geturl(), max_size))
+
+        reader, writer = connection
+        writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (
+            target, parts.netloc)).encode('latin-1'))
+        await writer.drain()
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError('Connection closed by server')
+            # 理由句は省略されることがある(HTTP/1.1 200)
+            version, _, rest = status_line.decode('latin-1').partition(' ')
+            status, _, reason = rest.strip().partition(' ')
+            if not version.startswith('HTTP/') or not status.isdigit():
+                raise OSError('GET %s failed: bad status line %r' % (
+                    parts.geturl(), status_line))
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            # 100 Continueなどの途中の応答は読み飛ばして本当の応答を待つ
+            if not status.startswith('1'):
+                break
+
+        keep_alive = (version == 'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close')
+        if status in ('204', '304'):
+            # 本文を持たない応答。Content-Lengthがなくても閉じるまで読まない
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            total = 0
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # トレーラーのヘッダーがあれば空行まで読み飛ばす
+                    line = await reader.readline()
+                    while line not in (b'\r\n', b'\n', b''):
+                        line = await reader.readline()
+                    break
+                total += size
+                check_size(total)
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            size = int(headers['content-length'])
+            check_size(size)
+            body = await reader.readexactly(size)
+        else:
+            # 長さがわからないので接続が閉じられるまで読む
+            chunks = []
+            total = 0
+            while True:
+                chunk = await reader.read(64 * 1024)
+                if not chunk:
+                    break
+                total += len(chunk)
+                check_size(total)
+                chunks.append(chunk)
+            body = b''.join(chunks)
+            keep_alive = False
+
+        if status != '200':
+            raise OSError('GET %s failed: %s %s' % (
+                parts.geturl(), status, reason.strip()))
+        return body, keep_alive
+
+class HTTPReadMixin(ChunkedReadMixin):
+    """self.urlをHTTPで読み込むmix-in"""
+    pool = HTTPConnectionPool()
+
+    def iter_raw_chunks(self, chunk_size):
+        return self.pool.get(self.url, chunk_size)
+
+    # async_mapreduce()でメモリに読み込む本文の上限
+    max_body_size = 64 * 1024 * 1024
+
+    async def aload(self, http_pool):
+        """本文を接続のプールで読み込み、読み込み済みの入力にして返す。
+        max_body_sizeを超える本文はOSErrorにする
+        """
+        body = await http_pool.get(self.url, self.max_body_size)
+        return BufferedGenericInputData(body)
+
+    def read(self):
+        return b''.join(self.iter_raw_chunks(self.chunk_size)).decode('utf-8')
+
+class NetworkInputData(HTTPReadMixin, InputData):
     """ネットワークから読み込む"""
-    pass
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
 
 
 
@@ -35,14 +345,14 @@ class Worker(object):
 class LineCountWorker(Worker):
     """改行のカウンタを定義"""
     def map(self):
-        data = self.input_data.read()
-        self.result = data.count('\n')
+        # デコードせずにバイト列のまま改行を数える
+        self.result = sum(
+            chunk.count(b'\n') for chunk in self.input_data.iter_chunks())
     
     def reduce(self, other):
         self.result += other.result
 
 # これらの部品を、ヘルパー関数でオブジェクトを構築し連携する
-import os
 def generate_inputs(data_dir):
     """ディレクトリの内容をリストして
     そこに含まれる各ファイルに対するインスタンスを作る
@@ -59,13 +369,102 @@ def create_workers(input_list):
         workers.append(LineCountWorker(input_data))
     return workers
 
+# スレッドではGILのためCPUバウンドなmap()が1つずつしか進まない。
+# concurrent.futuresのExecutorを差し替えられるようにして、
+# スレッド、プロセスプール、その場での実行を選べるようにする
+import multiprocessing
+from concurrent.futures import (
+    Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor)
+
+class InlineExecutor(Executor):
+    """呼び出したスレッドでそのまま実行するExecutor。
+    デバッグや計測の基準に使う
+    """
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+def make_executor(kind='thread', max_workers=None):
+    """kindに'thread'、'process'、'inline'を指定してExecutorを作る。
+    max_workersでプールのサイズを決める(Noneならコア数から決まる)。
+    processの子プロセスは、スレッドを持つ親からforkしないように
+    forkserver(なければspawn)から作る。子はこのスクリプトをimportし直すので、
+    例はif __name__ == '__main__':の中に置く
+    """
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+    if kind == 'process':
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in methods else 'spawn')
+        return ProcessPoolExecutor(max_workers=max_workers,
+                                   mp_context=context)
+    if kind == 'inline':
+        return InlineExecutor()
+    raise ValueError('Unknown executor kind: %r' % kind)
+
+def map_worker(worker):
+    """Executorで実行するmapステップ。プロセスプールでは
+    workerはpickleされて子プロセスに渡るので、mapした後の
+    コピーを返して親プロセスで使う。Workerにcombine()があれば
+    map()の直後に同じスレッド(プロセス)で呼ぶ
+    """
+    worker.map()
+    combine = getattr(worker, 'combine', None)
+    if combine is not None:
+        combine()
+    return worker
+
+def reduce_pair(left, right):
+    """Executorで実行するreduceステップ"""
+    left.reduce(right)
+    return left
+
+def tree_reduce(workers, executor):
+    """隣り合うWorkerを2つずつexecutorでreduceし、1つになるまで繰り返す。
+    1段ごとのreduceは並列に進むので、全体でlog2(n)段で終わる
+    """
+    while len(workers) > 1:
+        futures = [executor.submit(reduce_pair, left, right)
+                   for left, right in zip(workers[::2], workers[1::2])]
+        rest = workers[-1:] if len(workers) % 2 else []
+        workers = [future.result() for future in futures] + rest
+    return workers[0].result
+
 from threading import Thread
-def execute(workers):
+def execute(workers, executor=None, cache=None, parallel_reduce=False):
     """複数のスレッドに実行ステップをmapすることによって、
-    これらのWorkerを並列に実行する"""
-    threads = [Thread(target=w.map) for w in workers]
-    for thread in threads: thread.start()
-    for thread in threads: thread.join()
+    これらのWorkerを並列に実行する。executorを渡すと
+    スレッドの代わりにそのExecutorでmapする。cacheを渡すと
+    キャッシュに結果があるWorkerはmapせずにそのままreduceする。
+    parallel_reduceを指定するとexecutorでツリー状にreduceする
+    """
+    hits = []
+    if cache is not None:
+        misses = []
+        for worker in workers:
+            (hits if cache.load(worker) else misses).append(worker)
+        workers = misses
+
+    if executor is None:
+        threads = [Thread(target=map_worker, args=(w,)) for w in workers]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    else:
+        workers = list(executor.map(map_worker, workers))
+
+    if cache is not None:
+        for worker in workers:
+            cache.store(worker)
+        cache.commit()
+    workers = hits + workers
+
+    if parallel_reduce and executor is not None:
+        return tree_reduce(workers, executor)
 
     first, rest = workers[0], workers[1:]
     for worker in rest:
@@ -89,11 +488,12 @@ def write_test_files(tmpdir):
         with open(os.path.join(tmpdir, str(i)), 'w') as f:
             f.write('\n' * random.randint(0, 100))
 
-with TemporaryDirectory() as tmpdir:
-    write_test_files(tmpdir)
-    result = mapreduce(tmpdir)
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        result = mapreduce(tmpdir)
 
-print('There are', result, 'lines')
+    print('There are', result, 'lines')
 
 
 # mapreduce()がジェネリックではないので、@classmmethodポリモルフィズムを使う
@@ -109,8 +509,14 @@ class GenericInputData(object):
         """設定パラメータの辞書をもらう"""
         raise NotImplementedError
 
+    def cache_key(self):
+        """結果をキャッシュするためのキー。(入力を識別する文字列,
+        入力の版を表す文字列)のタプルを返す。Noneならキャッシュしない
+        """
+        return None
+
 
-class PathGenericInputData(GenericInputData):
+class PathGenericInputData(ChunkedReadMixin, GenericInputData):
     def __init__(self, path):
         super().__init__()
         self.path = path
@@ -118,12 +524,64 @@ class PathGenericInputData(GenericInputData):
     def read(self):
         return open(self.path).read()
     
+    def cache_key(self):
+        """ファイルのパスと読む範囲で識別し、サイズと更新時刻が
+        変わったら別の版とみなす
+        """
+        stat = os.stat(self.path)
+        return ('%s:%d:%s' % (self.path, self.start, self.end),
+                '%d:%d' % (stat.st_size, stat.st_mtime_ns))
+
     @classmethod
     def generate_inputs(cls, config):
-        """configで入力ファイルを探すディレクトリを指定する"""
+        """configで入力ファイルを探すディレクトリを指定する。
+        config['recursive']が真ならサブディレクトリの中のファイルも探す
+        """
         data_dir = config['data_dir']
-        for name in os.listdir(data_dir):
-            yield cls(os.path.join(data_dir, name))
+        if config.get('recursive'):
+            for path in cls.scan_files(data_dir):
+                yield cls(path)
+            return
+        # os.listdir()は全エントリのリストを作るので、os.scandir()で1つずつ取り出す
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                yield cls(entry.path)
+
+    @staticmethod
+    def scan_files(data_dir):
+        """data_dir以下のファイルのパスをos.scandir()で再帰的に返す"""
+        stack = [data_dir]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path
+
+class NetworkGenericInputData(HTTPReadMixin, GenericInputData):
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+
+    @classmethod
+    def generate_inputs(cls, config):
+        """config['urls']で読み込むURLのリストを指定する"""
+        for url in config['urls']:
+            yield cls(url)
+
+class BufferedGenericInputData(ChunkedReadMixin, GenericInputData):
+    """読み込み済みのbytesを入力として扱う"""
+    def __init__(self, data):
+        super().__init__()
+        self.data = data
+
+    def iter_raw_chunks(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+    def read(self):
+        return self.data.decode('utf-8')
 
 class GenericWorker(object):
     """入力データを標準的に消費するMapReduceのWorker"""
@@ -136,6 +594,12 @@ class GenericWorker(object):
     
     def reduce(self, other):
         raise NotImplementedError
+
+    def combine(self):
+        """map()の直後にmapと同じスレッド(プロセス)で呼ばれる。
+        reduceに渡す前に結果をまとめて小さくしたいときにオーバーライドする
+        """
+        pass
     
     @classmethod
     def create_workers(cls, input_class, config):
@@ -143,27 +607,995 @@ class GenericWorker(object):
         必要な入力を生成する。GenericWorkerの具象サブクラスのインスタンスを、
         cls()をジェネリックなコンストラクタとして呼び出し、作成する
         """
-        workers = []
+        return list(cls.iter_workers(input_class, config))
+
+    @classmethod
+    def iter_workers(cls, input_class, config):
+        """create_workers()と同じだが、入力をリストに集めずに
+        1つずつWorkerを作って返すジェネレータ
+        """
         for input_data in input_class.generate_inputs(config):
-            workers.append(cls(input_data))
-        return workers
+            yield cls(input_data)
+
+
+# 1ファイルが1入力なので、巨大なファイルが1つあると1つのWorkerだけが働く。
+# 大きなファイルは改行の位置に揃えたバイト範囲に分けて別々の入力にする
+class SplitPathGenericInputData(PathGenericInputData):
+    """split_sizeより大きなファイルを複数のバイト範囲に分割する。
+    範囲の境界は必ず改行の直後なので、レコードが2つの入力にまたがらない
+    """
+    split_size = 64 * 1024 * 1024
+
+    def __init__(self, path, start=0, end=None):
+        super().__init__(path)
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def generate_inputs(cls, config):
+        """config['split_size']でファイルを分割する大きさを指定する。
+        それ以下のファイルは分割しない
+        """
+        split_size = config.get('split_size', cls.split_size)
+        for input_data in super().generate_inputs(config):
+            path = input_data.path
+            size = os.path.getsize(path)
+            if size <= split_size:
+                yield input_data
+                continue
+            for start, end in cls.split_ranges(path, size, split_size):
+                yield cls(path, start, end)
+
+    @staticmethod
+    def split_ranges(path, size, split_size):
+        """およそsplit_sizeごとに区切り、次の改行まで境界をずらす"""
+        with open(path, 'rb') as f:
+            start = 0
+            while size - start > split_size:
+                f.seek(start + split_size)
+                f.readline()
+                end = f.tell()
+                if end >= size:
+                    break
+                yield start, end
+                start = end
+            yield start, size
+
+    def read(self):
+        """ファイル全体ではなく、このバイト範囲だけをデコードして返す"""
+        return ''.join(self.iter_chunks(encoding='utf-8'))
 
 
 class LineCountGenericWorker(GenericWorker):
     def map(self):
-        data = self.input_data.read()
-        self.result = data.count('\n')
+        # デコードせずにバイト列のまま改行を数える
+        self.result = sum(
+            chunk.count(b'\n') for chunk in self.input_data.iter_chunks())
 
     def reduce(self, other):
         self.result += other.result
 
 
-def generic_mapreduce(worker_cls, input_cls, config):
-    workers = worker_cls.create_workers(input_cls, config)
-    return execute(workers)
+# execute()はWorkerの数だけスレッドを作り、全WorkerをリストにもつのでWorkerが
+# 20万個なら20万スレッドになる。入力を必要な分だけ取り出し、同時に実行する
+# mapの数を抑え、終わったものから順にreduceする
+from concurrent.futures import FIRST_COMPLETED, wait
+def execute_streaming(workers, executor, max_in_flight, cache=None,
+                      parallel_reduce=False, stats=None):
+    """workersのイテレータからWorkerを取り出してexecutorでmapする。
+    同時に実行中のmapはmax_in_flight個までで、それを超えるとどれかが
+    終わるまで待つ。結果はmapが終わった順にreduceするので、
+    保持するWorkerはmax_in_flight + 1個を超えない。
+    parallel_reduceを指定すると、結果が2つそろうたびにreduceも
+    executorに渡すので、mapの実行中にreduceが並列に進む。
+    statsにMapReduceStatsを渡すと各段階の時間を記録する
+    """
+    first = None
+    pending = set()
+    reducing = set()
+    if stats is not None:
+        stats.start()
+        workers = stats.timed_listing(workers)
+
+    def reduce_worker(worker):
+        nonlocal first
+        if first is None:
+            first = worker
+        elif parallel_reduce:
+            future = executor.submit(reduce_pair, first, worker)
+            pending.add(future)
+            reducing.add(future)
+            first = None
+        else:
+            begin = perf_counter()
+            first.reduce(worker)
+            if stats is not None:
+                stats.reduce_seconds += perf_counter() - begin
+
+    def reduce_done(done):
+        for future in done:
+            worker = future.result()
+            if future in reducing:
+                reducing.discard(future)
+            else:
+                if cache is not None:
+                    cache.store(worker)
+                if stats is not None:
+                    stats.record(worker)
+            reduce_worker(worker)
+
+    for worker in workers:
+        if cache is not None and cache.load(worker):
+            if stats is not None:
+                stats.cache_hits += 1
+            reduce_worker(worker)
+            continue
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            reduce_done(done)
+        if stats is None:
+            pending.add(executor.submit(map_worker, worker))
+        else:
+            pending.add(stats.submit(executor, worker))
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        reduce_done(done)
+    if cache is not None:
+        cache.commit()
+    if stats is not None:
+        stats.stop()
+
+    return None if first is None else first.result
+
+# 毎回すべての入力をmapし直すのは無駄なので、変更のない入力は前回の
+# mapの結果を使う。結果はWorkerのクラスと入力のcache_key()をキーにしてsqliteに保存する
+import pickle
+import sqlite3
+class ResultCache(object):
+    """mapの結果を永続化するキャッシュ。作ったスレッドだけで使う"""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'worker TEXT, input TEXT, version TEXT, result BLOB, '
+            'PRIMARY KEY (worker, input))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _worker_name(worker):
+        cls = type(worker)
+        return '%s.%s' % (cls.__module__, cls.__qualname__)
+
+    def load(self, worker):
+        """キャッシュに同じ版の結果があればworker.resultに入れてTrueを返す。
+        キーはmapの前にここで1回だけ求めてworker.cache_keyに覚えておく。
+        mapの後に求め直すと、その間に書き換わった入力の新しい版で
+        古い結果を保存してしまう
+        """
+        key = worker.cache_key = worker.input_data.cache_key()
+        if key is None:
+            return False
+        row = self.db.execute(
+            'SELECT version, result FROM results WHERE worker = ? AND input = ?',
+            (self._worker_name(worker), key[0])).fetchone()
+        if row is None or row[0] != key[1]:
+            return False
+        worker.result = pickle.loads(row[1])
+        return True
+
+    def store(self, worker):
+        """mapした結果をload()が求めたキーで保存する。古い版の結果は置き換える。
+        load()していないWorkerは保存しない
+        """
+        key = getattr(worker, 'cache_key', None)
+        if key is None:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+            (self._worker_name(worker), key[0], key[1],
+             pickle.dumps(worker.result)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+# Workerの結果が1つの値だけだと、単語数やキーごとの集計ができない。
+# mapが(key, value)の組を出力し、キーのハッシュでR個のパーティションに分け、
+# メモリに収まらないパーティションはソートしてファイルに書き出す
+class KeyedGenericWorker(GenericWorker):
+    """mapで(key, value)の組を出力するWorker。generic_mapreduce()の
+    結果は、キーごとにreduce_key()でまとめた値の辞書になる
+    """
+    # reduce_key()でまとめた値をもう一度reduce_key()に渡してよい(和のように
+    # 結合的な)ときはTrueにすると、書き出す前に同じキーの組をまとめる
+    combine_pairs = False
+    # execute_keyed()がmapの前にShuffle.map_side_args()の値を入れる
+    shuffle_args = None
+
+    def map(self):
+        """map_pairs()の組を出すそばからパーティションに分け、メモリの予算を
+        超えた分はソートしてファイルに書き出す。resultは(runs, buffers)になる
+        """
+        combiner = self.reduce_key if self.combine_pairs else None
+        shuffle = Shuffle(*self.shuffle_args, combiner=combiner)
+        shuffle.add(self.map_pairs())
+        self.result = shuffle.output()
+
+    def map_pairs(self):
+        """(key, value)の組を返すイテレータ。keyはソートできる必要がある"""
+        raise NotImplementedError
+
+    @classmethod
+    def reduce_key(cls, key, values):
+        """1つのキーのすべての値のイテレータをもらって1つの値にまとめる"""
+        raise NotImplementedError
+
+
+import heapq
+import tempfile
+import zlib
+from itertools import groupby
+from operator import itemgetter
+def partition_of(key, partitions):
+    """キーのパーティション番号。文字列のhash()はプロセスごとに変わるので、
+    子プロセスでmapしても同じ番号になるようにreprのCRC32を使う
+    """
+    return zlib.crc32(repr(key).encode()) % partitions
+
+def write_run(path, pairs, block_size=1024):
+    """ソート済みの組をblock_size個ずつpickleしてファイルに書く"""
+    with open(path, 'wb') as f:
+        for i in range(0, len(pairs), block_size):
+            pickle.dump(pairs[i:i + block_size], f)
+
+def read_run(path):
+    """write_run()で書いたファイルから組を順に読み出す"""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            yield from block
+
+def reduce_partition(worker_cls, run_paths, pairs):
+    """書き出したファイルとメモリ上の組をキーの順にマージしながら
+    キーごとにreduce_key()する
+    """
+    first_key = itemgetter(0)
+    runs = [read_run(path) for path in run_paths]
+    runs.append(sorted(pairs, key=first_key))
+    merged = heapq.merge(*runs, key=first_key)
+    result = {}
+    for key, group in groupby(merged, key=first_key):
+        result[key] = worker_cls.reduce_key(key, (value for _, value in group))
+    return result
+
+class Shuffle(object):
+    """(key, value)の組をキーのハッシュでpartitions個のパーティションに分ける。
+    1つのパーティションがmemory_budget // partitions個を超えると、
+    ソートして一時ファイルに書き出す。directoryを渡さなければ一時ディレクトリを
+    作り、終わるときに消す。combinerを渡すと書き出す前に同じキーの組を
+    combiner(key, values)でまとめる
+    """
+    def __init__(self, partitions=4, memory_budget=1000000, directory=None,
+                 combiner=None):
+        self.partitions = partitions
+        self.memory_budget = memory_budget
+        self.limit = max(1, memory_budget // partitions)
+        self.combiner = combiner
+        self.buffers = [[] for _ in range(partitions)]
+        self.runs = [[] for _ in range(partitions)]
+        self.tmpdir = None
+        if directory is None:
+            self.tmpdir = tempfile.TemporaryDirectory()
+            directory = self.tmpdir.name
+        self.directory = directory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.tmpdir is not None:
+            self.tmpdir.cleanup()
+
+    @property
+    def spill_count(self):
+        return sum(len(runs) for runs in self.runs)
+
+    def add(self, pairs):
+        for pair in pairs:
+            index = partition_of(pair[0], self.partitions)
+            buffer = self.buffers[index]
+            buffer.append(pair)
+            if len(buffer) >= self.limit:
+                self.spill(index)
+
+    def sort(self, index):
+        """パーティションの組をキーでソートし、combinerがあればまとめる"""
+        buffer = self.buffers[index]
+        buffer.sort(key=itemgetter(0))
+        if self.combiner is not None:
+            buffer = [(key, self.combiner(key, (value for _, value in group)))
+                      for key, group in groupby(buffer, key=itemgetter(0))]
+            self.buffers[index] = buffer
+        return buffer
+
+    def spill(self, index):
+        buffer = self.sort(index)
+        # mapする子プロセスも同じディレクトリに書くので名前はmkstempで決める
+        fd, path = tempfile.mkstemp(prefix='%d-' % index, dir=self.directory)
+        os.close(fd)
+        write_run(path, buffer)
+        self.runs[index].append(path)
+        self.buffers[index] = []
+
+    def map_side_args(self, max_in_flight):
+        """mapの側で使うShuffleの引数。同時に実行するmapでメモリの予算を
+        分け合い、書き出すファイルはこのShuffleのディレクトリに置く
+        """
+        return (self.partitions,
+                max(self.partitions, self.memory_budget // max_in_flight),
+                self.directory)
+
+    def output(self):
+        """mapの側のShuffleの結果。残った組もソートしてまとめておく"""
+        return self.runs, [self.sort(index) for index in range(self.partitions)]
+
+    def merge(self, output):
+        """mapの側のShuffleのoutput()を受け取る。書き出したファイルは
+        そのまま使い、メモリ上の組は予算を超えたら書き出す
+        """
+        runs, buffers = output
+        for index in range(self.partitions):
+            self.runs[index].extend(runs[index])
+            self.buffers[index].extend(buffers[index])
+            if len(self.buffers[index]) >= self.limit:
+                self.spill(index)
+
+    def reduce(self, worker_cls, executor):
+        """パーティションごとのreduceをexecutorで並列に実行する"""
+        futures = [
+            executor.submit(reduce_partition, worker_cls, runs, buffer)
+            for runs, buffer in zip(self.runs, self.buffers)]
+        result = {}
+        for future in futures:
+            result.update(future.result())
+        return result
+
+def execute_keyed(worker_cls, workers, executor, max_in_flight, shuffle):
+    """execute_streaming()と同じように同時に実行するmapを抑えながら、
+    mapが終わった順に組をshuffleに入れ、最後にパーティションごとにreduceする。
+    各mapは組を出しながら自分で分けて書き出すので、1つの入力の組を
+    すべてメモリに持つことはない
+    """
+    pending = set()
+    shuffle_args = shuffle.map_side_args(max_in_flight)
+
+    def shuffle_done(done):
+        for future in done:
+            shuffle.merge(future.result().result)
+
+    for worker in workers:
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            shuffle_done(done)
+        worker.shuffle_args = shuffle_args
+        pending.add(executor.submit(map_worker, worker))
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        shuffle_done(done)
+    return shuffle.reduce(worker_cls, executor)
+
+def keyed_mapreduce(worker_cls, input_cls, config, executor, max_in_flight):
+    """config['partitions']でパーティション数を、config['memory_budget']で
+    メモリに保持する組の数を指定する
+    """
+    workers = worker_cls.iter_workers(input_cls, config)
+    with Shuffle(config.get('partitions', 4),
+                 config.get('memory_budget', 1000000)) as shuffle:
+        return execute_keyed(
+            worker_cls, workers, executor, max_in_flight, shuffle)
+
+# 実行時間が入力の列挙、読み込み、map、キューの待ち、reduceの
+# どこで使われているのかわからないので、必要なときだけ記録できるようにする
+import cProfile
+import json
+import pstats
+from time import time
+class ProfileData(object):
+    """pstats.Statsに渡せる、pickleできるcProfileの結果"""
+    def __init__(self, profiler):
+        profiler.create_stats()
+        self.stats = profiler.stats
+
+    def create_stats(self):
+        pass
+
+def timed_map_worker(worker, submitted, profile=False):
+    """map_worker()を実行して、キューで待った時間とmapにかかった時間を
+    worker.timingに入れる。profileが真ならcProfileで計測する
+    """
+    started = time()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    begin = perf_counter()
+    try:
+        map_worker(worker)
+    finally:
+        if profile:
+            profiler.disable()
+    worker.timing = {
+        'queued': max(0.0, started - submitted),
+        'seconds': perf_counter() - begin,
+        'runner': '%d:%s' % (os.getpid(), threading.current_thread().name),
+        'profile': ProfileData(profiler) if profile else None,
+    }
+    return worker
+
+def describe_input(input_data):
+    """レポートに出す入力の名前"""
+    url = getattr(input_data, 'url', None)
+    if url is not None:
+        return url
+    path = getattr(input_data, 'path', None)
+    if path is None:
+        return repr(input_data)
+    if input_data.start or input_data.end is not None:
+        return '%s[%d:%s]' % (path, input_data.start, input_data.end)
+    return path
+
+class MapReduceStats(object):
+    """generic_mapreduce()に渡すと、実行の各段階にかかった時間と
+    入力ごとのバイト数を記録する。遅い入力はslowest個だけ覚えておく。
+    readの時間はChunkedReadMixin.iter_chunks()で読んだ分だけを数え、
+    mapの時間はそれを除いた分になる
+    """
+    def __init__(self, slowest=10, profile=False):
+        self.slowest_count = slowest
+        self.profile = profile
+        self.inputs = 0
+        self.cache_hits = 0
+        self.bytes = 0
+        self.listing_seconds = 0.0
+        self.queued_seconds = 0.0
+        self.read_seconds = 0.0
+        self.map_seconds = 0.0
+        self.reduce_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.busy_seconds = {}
+        self.slowest = []
+        self.profile_stats = None
+        self._started = None
+
+    def start(self):
+        self._started = perf_counter()
+
+    def stop(self):
+        self.wall_seconds += perf_counter() - self._started
+
+    def timed_listing(self, workers):
+        """入力を列挙してWorkerを作るのにかかった時間を数える"""
+        workers = iter(workers)
+        while True:
+            begin = perf_counter()
+            worker = next(workers, None)
+            self.listing_seconds += perf_counter() - begin
+            if worker is None:
+                return
+            yield worker
+
+    def submit(self, executor, worker):
+        return executor.submit(timed_map_worker, worker, time(), self.profile)
+
+    def record(self, worker):
+        """timed_map_worker()で実行されたWorkerの記録を集計する"""
+        timing = worker.timing
+        input_data = worker.input_data
+        read_seconds = getattr(input_data, 'read_seconds', 0.0)
+        size = getattr(input_data, 'bytes_read', 0)
+        self.inputs += 1
+        self.bytes += size
+        self.queued_seconds += timing['queued']
+        self.read_seconds += read_seconds
+        self.map_seconds += timing['seconds'] - read_seconds
+        runner = timing['runner']
+        self.busy_seconds[runner] = (
+            self.busy_seconds.get(runner, 0.0) + timing['seconds'])
+
+        entry = (timing['seconds'], self.inputs, {
+            'input': describe_input(input_data),
+            'bytes': size,
+            'seconds': timing['seconds'],
+            'read_seconds': read_seconds,
+            'queued_seconds': timing['queued'],
+        })
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest_count:
+            heapq.heappushpop(self.slowest, entry)
+
+        if timing['profile'] is not None:
+            if self.profile_stats is None:
+                self.profile_stats = pstats.Stats(timing['profile'])
+            else:
+                self.profile_stats.add(timing['profile'])
+
+    def report(self):
+        """集計結果をJSONにできる辞書で返す。utilisationはmapを実行した
+        スレッド(プロセス)がwall時間のうち働いていた割合の平均
+        """
+        busy = sum(self.busy_seconds.values())
+        runners = len(self.busy_seconds)
+        wall = self.wall_seconds
+        return {
+            'inputs': self.inputs,
+            'cache_hits': self.cache_hits,
+            'bytes': self.bytes,
+            'wall_seconds': wall,
+            'phases': {
+                'listing': self.listing_seconds,
+                'queued': self.queued_seconds,
+                'read': self.read_seconds,
+                'map': self.map_seconds,
+                'reduce': self.reduce_seconds,
+            },
+            'throughput_mb_per_second': self.bytes / wall / 1e6 if wall else 0.0,
+            'runners': runners,
+            'utilisation': busy / (wall * runners) if wall and runners else 0.0,
+            'slowest_inputs': [
+                record for _, _, record in sorted(self.slowest, reverse=True)],
+        }
+
+    def to_json(self, path=None):
+        """report()をJSONにする。pathを指定するとファイルにも書く"""
+        text = json.dumps(self.report(), indent=2, ensure_ascii=False)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def print_profile(self, limit=10, sort='cumulative'):
+        if self.profile_stats is None:
+            raise ValueError('Run with MapReduceStats(profile=True)')
+        self.profile_stats.sort_stats(sort).print_stats(limit)
+
+def generic_mapreduce(worker_cls, input_cls, config, executor=None,
+                      max_in_flight=None, cache=None, parallel_reduce=False,
+                      stats=None):
+    """max_in_flightを指定すると入力を1つずつ取り出して、
+    同時にmapする数をその数までに抑える。cacheにResultCacheを
+    渡すと変更のない入力のmapを省く。parallel_reduceを指定すると
+    reduceもexecutorでツリー状に進める。statsにMapReduceStatsを渡すと
+    execute_streaming()で実行して各段階の時間を記録する。worker_clsが
+    KeyedGenericWorkerのサブクラスならキーごとの結果の辞書を返す。
+    そのときcache、parallel_reduce、statsは使えない
+    """
+    if issubclass(worker_cls, KeyedGenericWorker):
+        if cache is not None or parallel_reduce or stats is not None:
+            raise ValueError(
+                'cache, parallel_reduce and stats are not supported '
+                'for %s' % worker_cls.__name__)
+        if max_in_flight is None:
+            max_in_flight = 2 * (os.cpu_count() or 1)
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+                return keyed_mapreduce(
+                    worker_cls, input_cls, config, executor, max_in_flight)
+        return keyed_mapreduce(
+            worker_cls, input_cls, config, executor, max_in_flight)
+
+    if max_in_flight is None and stats is not None:
+        max_in_flight = 2 * (os.cpu_count() or 1)
+    if max_in_flight is None:
+        workers = worker_cls.create_workers(input_cls, config)
+        return execute(workers, executor, cache, parallel_reduce)
+
+    workers = worker_cls.iter_workers(input_cls, config)
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            return execute_streaming(workers, executor, max_in_flight,
+                                     cache, parallel_reduce, stats)
+    return execute_streaming(workers, executor, max_in_flight,
+                             cache, parallel_reduce, stats)
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        result = generic_mapreduce(LineCountGenericWorker, PathGenericInputData, config)
+    print('There are', result, 'lines')
+
+
+# Executorを切り替えて計測する。workerとinputはpickleできる必要があるので、
+# モジュールのトップレベルで定義したクラスを使う
+def write_large_test_files(tmpdir, count=100, size=1024 * 1024):
+    line = b'x' * 79 + b'\n'
+    for i in range(count):
+        with open(os.path.join(tmpdir, str(i)), 'wb') as f:
+            f.write(line * (size // len(line)))
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_large_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        for kind in ('inline', 'thread', 'process'):
+            with make_executor(kind, max_workers=os.cpu_count()) as executor:
+                start = perf_counter()
+                result = generic_mapreduce(
+                    LineCountGenericWorker, PathGenericInputData, config, executor)
+                end = perf_counter()
+            print('%-7s: %d lines in %.3f seconds' % (kind, result, end - start))
+"""
+1コアのマシンでは差がでない(threadはread()のI/O待ちが重なる分だけ速い)。
+processはforkserverから子プロセスを起動する時間も含む
+> inline : 1310700 lines in 0.079 seconds
+> thread : 1310700 lines in 0.059 seconds
+> process: 1310700 lines in 0.257 seconds
+
+コア数が増えるとprocessだけがmap()を同時に進められる。
+"""
+
+
+# 入力がいくつあってもスレッドは最大でmax_in_flight個しか増えない
+class PeakThreadsWorker(LineCountGenericWorker):
+    """map中に生きているスレッド数の最大値を記録する"""
+    peak_threads = 0
+
+    def map(self):
+        super().map()
+        cls = PeakThreadsWorker
+        cls.peak_threads = max(cls.peak_threads, threading.active_count())
+
+def write_many_test_files(tmpdir, count=5000):
+    for i in range(count):
+        with open(os.path.join(tmpdir, str(i)), 'w') as f:
+            f.write('\n' * (i % 10))
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_many_test_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        result = generic_mapreduce(
+            PeakThreadsWorker, PathGenericInputData, config, max_in_flight=8)
+    print('There are', result, 'lines with at most',
+          PeakThreadsWorker.peak_threads, 'threads')
+"""
+> There are 22500 lines with at most 9 threads
+"""
+
+
+# テキストとして扱いたいWorkerはencodingを指定してiter_chunks()を使う
+class CharCountGenericWorker(GenericWorker):
+    def map(self):
+        self.result = sum(
+            len(text) for text in self.input_data.iter_chunks(encoding='utf-8'))
+
+    def reduce(self, other):
+        self.result += other.result
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, 'text'), 'w', encoding='utf-8') as f:
+            f.write('こんにちは\n' * 1000)
+        config = {'data_dir': tmpdir}
+        lines = generic_mapreduce(
+            LineCountGenericWorker, PathGenericInputData, config)
+        PathGenericInputData.chunk_size = 7 # マルチバイト文字の途中で切れる大きさ
+        chars = generic_mapreduce(
+            CharCountGenericWorker, PathGenericInputData, config)
+        del PathGenericInputData.chunk_size
+    print('There are', lines, 'lines and', chars, 'characters')
+"""
+> There are 1000 lines and 6000 characters
+"""
+
+
+# 大きなファイルを分割しても改行の数は変わらない
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        with open(os.path.join(tmpdir, 'large'), 'w') as f:
+            for i in range(100000):
+                f.write('x' * (i % 50) + '\n')
+        config = {'data_dir': tmpdir, 'split_size': 256 * 1024}
+        inputs = list(SplitPathGenericInputData.generate_inputs(config))
+        whole = generic_mapreduce(
+            LineCountGenericWorker, PathGenericInputData, config)
+        split = generic_mapreduce(
+            LineCountGenericWorker, SplitPathGenericInputData, config)
+        # read()も自分の範囲だけを返すので、足すと元のファイルと同じになる
+        read_lines = sum(input_data.read().count('\n') for input_data in inputs)
+    print(len(inputs), 'inputs:', whole, '==', split, '==', read_lines, 'lines')
+"""
+> 110 inputs: 105155 == 105155 == 105155 lines
+"""
+
+
+# 2回目は変更したファイルだけがmapされる
+class MapCountWorker(LineCountGenericWorker):
+    """map()が呼ばれた回数を記録する"""
+    map_count = 0
+
+    def map(self):
+        MapCountWorker.map_count += 1
+        super().map()
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        data_dir = os.path.join(tmpdir, 'data')
+        os.mkdir(data_dir)
+        write_test_files(data_dir)
+        config = {'data_dir': data_dir}
+        with ResultCache(os.path.join(tmpdir, 'cache.sqlite3')) as cache:
+            with InlineExecutor() as executor:
+                first = generic_mapreduce(
+                    MapCountWorker, PathGenericInputData, config, executor,
+                    cache=cache)
+                first_maps, MapCountWorker.map_count = MapCountWorker.map_count, 0
+                with open(os.path.join(data_dir, '0'), 'a') as f:
+                    f.write('\n' * 10)
+                second = generic_mapreduce(
+                    MapCountWorker, PathGenericInputData, config, executor,
+                    max_in_flight=4, cache=cache)
+    print('First: %d lines (%d maps), second: %d lines (%d maps)' %
+          (first, first_maps, second, MapCountWorker.map_count))
+"""
+> First: 5411 lines (100 maps), second: 5421 lines (1 maps)
+"""
+
+
+# dictのマージのようにreduceが重いと、1つずつ畳み込むreduceが最後に残る。
+# 単語を数えるWorkerで、畳み込みとツリー状のreduceを比べる
+from collections import Counter
+def iter_words(input_data):
+    """空白で区切った単語を順に返す"""
+    rest = ''
+    for text in input_data.iter_chunks(encoding='utf-8'):
+        words = (rest + text).split()
+        # チャンクの境界で切れた単語は次のチャンクにつなげる
+        rest = '' if text[-1:].isspace() or not words else words.pop()
+        yield from words
+    if rest:
+        yield rest
+
+class WordCountGenericWorker(GenericWorker):
+    """mapは単語を集めるだけにして、combineでプールの中で数える"""
+    def map(self):
+        self.result = list(iter_words(self.input_data))
+
+    def combine(self):
+        self.result = Counter(self.result)
+
+    def reduce(self, other):
+        self.result.update(other.result)
+
+def write_word_files(tmpdir, count=50, words=20000):
+    vocabulary = ['word%d' % i for i in range(20000)]
+    for i in range(count):
+        with open(os.path.join(tmpdir, str(i)), 'w') as f:
+            f.write(' '.join(random.choices(vocabulary, k=words)))
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_word_files(tmpdir)
+        config = {'data_dir': tmpdir}
+        for kind in ('thread', 'process'):
+            for parallel_reduce in (False, True):
+                with make_executor(kind) as executor:
+                    start = perf_counter()
+                    result = generic_mapreduce(
+                        WordCountGenericWorker, PathGenericInputData, config,
+                        executor, max_in_flight=8, parallel_reduce=parallel_reduce)
+                    end = perf_counter()
+                print('%-7s %-4s: %d words in %.3f seconds' % (
+                    kind, 'tree' if parallel_reduce else 'fold',
+                    sum(result.values()), end - start))
+"""
+1コアのマシンではreduceが並列に進まず、ツリーにした分のやりとりが増えるだけ遅くなる。
+プロセスプールではreduceのたびに2つのCounterをpickleするのでさらに遅い
+> thread  fold: 1000000 words in 0.324 seconds
+> thread  tree: 1000000 words in 0.394 seconds
+> process fold: 1000000 words in 0.549 seconds
+> process tree: 1000000 words in 1.325 seconds
+
+ツリーが効くのは、コアが余っていてreduce自体がpickleより重いときだけ。
+"""
+
+
+# キーごとに集計する。memory_budgetを小さくするとパーティションがファイルに書き出される
+class KeyedWordCountWorker(KeyedGenericWorker):
+    # 同じ入力の中の同じ単語はmapしたスレッドの中で先に足しておく
+    combine_pairs = True
+
+    def map_pairs(self):
+        for word in iter_words(self.input_data):
+            yield word, 1
+
+    @classmethod
+    def reduce_key(cls, key, values):
+        return sum(values)
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_word_files(tmpdir, count=10, words=5000)
+        config = {'data_dir': tmpdir, 'partitions': 4, 'memory_budget': 10000}
+        counts = generic_mapreduce(
+            WordCountGenericWorker, PathGenericInputData, config)
+        keyed_counts = generic_mapreduce(
+            KeyedWordCountWorker, PathGenericInputData, config)
+        with ThreadPoolExecutor(max_workers=4) as executor, Shuffle(4, 10000) as shuffle:
+            workers = KeyedWordCountWorker.iter_workers(PathGenericInputData, config)
+            execute_keyed(KeyedWordCountWorker, workers, executor, 4, shuffle)
+    print('Same counts:', counts == keyed_counts, 'with',
+          shuffle.spill_count, 'spilled runs')
+"""
+> Same counts: True with 63 spilled runs
+"""
+
+
+# 入力の列挙と読み込みをasyncioで行えば、遅いネットワークの入力を
+# スレッドを増やさずに何千も同時に待てる。mapはexecutorで実行する
+from itertools import islice
+async def agenerate_inputs(input_cls, config, batch_size=256):
+    """generate_inputs()をスレッドでbatch_size個ずつ進めて、
+    イベントループを止めずに入力を返す
+    """
+    inputs = input_cls.generate_inputs(config)
+    while True:
+        batch = await asyncio.to_thread(lambda: list(islice(inputs, batch_size)))
+        if not batch:
+            return
+        for input_data in batch:
+            yield input_data
+
+async def async_mapreduce(worker_cls, input_cls, config, limit=100,
+                          executor=None):
+    """読み込みからmapまでを同時にlimit個まで進める。入力のaload()が返す
+    入力をexecutor(Noneならループのデフォルト)でmapし、終わった順に
+    reduceする。ファイルはmapの中で少しずつ読み、HTTPの本文だけを
+    上限つきでメモリに読み込む
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(limit)
+    first = None
+
+    async def run(input_data, http_pool):
+        nonlocal first
+        try:
+            worker = worker_cls(await input_data.aload(http_pool))
+            worker = await loop.run_in_executor(executor, map_worker, worker)
+        finally:
+            semaphore.release()
+        if first is None:
+            first = worker
+        else:
+            first.reduce(worker)
+
+    async with AsyncHTTPConnectionPool() as http_pool:
+        tasks = []
+        async for input_data in agenerate_inputs(input_cls, config):
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(run(input_data, http_pool)))
+        await asyncio.gather(*tasks)
+
+    return None if first is None else first.result
+
+
+# ローカルのhttp.serverを相手に、同じファイルをディスクとHTTPの両方から数える
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-aliveで接続を使い回せるようにする
+    disable_nagle_algorithm = True # ヘッダと本文を別々に送っても待たされない
+
+    def log_message(self, format, *args):
+        pass
+
+class LocalHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024 # 同時に100接続してもSYNが捨てられない
+
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_test_files(tmpdir)
+        os.mkdir(os.path.join(tmpdir, 'sub'))
+        write_test_files(os.path.join(tmpdir, 'sub'))
+        config = {'data_dir': tmpdir, 'recursive': True}
+        local = asyncio.run(async_mapreduce(
+            LineCountGenericWorker, PathGenericInputData, config))
+
+        handler = partial(QuietHTTPRequestHandler, directory=tmpdir)
+        with LocalHTTPServer(('127.0.0.1', 0), handler) as server:
+            Thread(target=server.serve_forever, daemon=True).start()
+            base = 'http://127.0.0.1:%d/' % server.server_address[1]
+            urls = [base + os.path.relpath(path, tmpdir)
+                    for path in PathGenericInputData.scan_files(tmpdir)]
+            remote = asyncio.run(async_mapreduce(
+                LineCountGenericWorker, NetworkGenericInputData, {'urls': urls}))
+            blocking = execute([LineCountWorker(NetworkInputData(url))
+                                for url in urls])
+            server.shutdown()
+    print(len(urls), 'files:', local, '==', remote, '==', blocking, 'lines')
+
+
+# 理由句のない状態行、途中の100 Continue、本文もContent-Lengthもない204、
+# トレーラーつきのchunkedを返すサーバを相手に、止まらずに読めることを確かめる
+RAW_RESPONSES = [
+    b'HTTP/1.1 100 Continue\r\n\r\n'
+    b'HTTP/1.1 200\r\nContent-Length: 5\r\n\r\nhello',
+    b'HTTP/1.1 204 No Content\r\n\r\n',
+    b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+    b'5\r\nworld\r\n0\r\nX-Checksum: 1\r\n\r\n',
+]
+
+async def fetch_raw_responses():
+    responses = iter(RAW_RESPONSES)
+    handlers = []
+
+    async def handle(reader, writer):
+        handlers.append(asyncio.current_task())
+        try:
+            while True:
+                await reader.readuntil(b'\r\n\r\n')
+                writer.write(next(responses))
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:%d/' % server.sockets[0].getsockname()[1]
+    results = []
+    async with AsyncHTTPConnectionPool() as http_pool:
+        for _ in RAW_RESPONSES:
+            try:
+                results.append(await asyncio.wait_for(http_pool.get(url), 5))
+            except OSError as e:
+                results.append(e)
+    # プールが接続を閉じたので、サーバ側も読み終えて終わる
+    await asyncio.gather(*handlers)
+    server.close()
+    await server.wait_closed()
+    return results, len(handlers)
+
+if __name__ == '__main__':
+    results, connections = asyncio.run(fetch_raw_responses())
+    for result in results:
+        if isinstance(result, OSError): # URLのポートは毎回変わるので省く
+            result = '%s: %s' % (type(result).__name__,
+                                 str(result).rpartition(' failed: ')[2])
+        print(result)
+    print(connections, 'connections')
+"""
+> b'hello'
+> OSError: 204 No Content
+> b'world'
+> 2 connections
+"""
+
 
-with TemporaryDirectory() as tmpdir:
-    write_test_files(tmpdir)
-    config = {'data_dir': tmpdir}
-    result = generic_mapreduce(LineCountGenericWorker, PathGenericInputData, config)
-print('There are', result, 'lines')
\ No newline at end of file
+# どこに時間を使っているかを記録する
+if __name__ == '__main__':
+    with TemporaryDirectory() as tmpdir:
+        write_large_test_files(tmpdir, count=20)
+        config = {'data_dir': tmpdir}
+        stats = MapReduceStats(slowest=3, profile=True)
+        with make_executor('process', max_workers=2) as executor:
+            result = generic_mapreduce(
+                LineCountGenericWorker, PathGenericInputData, config, executor,
+                stats=stats)
+    report = json.loads(stats.to_json())
+    print('There are', result, 'lines;', report['inputs'], 'inputs,',
+          '%.1f MB/s, utilisation %.2f' % (
+              report['throughput_mb_per_second'], report['utilisation']))
+    print('Phases:', ', '.join(
+        '%s %.3fs' % item for item in report['phases'].items()))
+    stats.print_profile(3)
@@ -95,3 +95,555 @@ except subprocess.TimeoutExpired:
     proc.wait()
 
 print('Exit status', proc.poll())
+
+
+"""
+子プロセスをまとめて全部起動すると、1万個のコマンドなら1万回forkして
+パイプのファイルディスクリプタも3万個必要になる。
+SubprocessPoolは同時に動かす子プロセスをmax_procs個までに抑え、残りは
+ThreadPoolExecutorのキューで待たせる。キューにはコマンドしか入らないので
+プロセスもファイルディスクリプタも使わない。
+タイムアウトはコマンドごと(timeout)と全体(deadline)の2つで、時間切れの
+子プロセスはまずterminate()し、grace秒待っても終わらなければkill()する。
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import monotonic
+
+ProcessResult = namedtuple('ProcessResult', [
+    'args', 'returncode', 'stdout', 'stderr', 'timed_out', 'seconds'])
+
+def stop_process(proc, grace=1.0):
+    """terminate()で止め、grace秒で終わらなければkill()する。終了コードを返す"""
+    proc.terminate()
+    try:
+        return proc.wait(grace)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        return proc.wait()
+
+class SubprocessPool(object):
+    """submit()でコマンドを渡し、結果のProcessResultをFutureで受け取る"""
+    def __init__(self, max_procs=None, timeout=None, deadline=None, grace=1.0):
+        """timeoutはコマンドごとの、deadlineは全体の制限時間(秒)"""
+        self.max_procs = max_procs or os.cpu_count()
+        self.timeout = timeout
+        self.deadline = None if deadline is None else monotonic() + deadline
+        self.grace = grace
+        self.executor = ThreadPoolExecutor(max_workers=self.max_procs)
+
+    def _time_limit(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        if self.deadline is not None:
+            remaining = self.deadline - monotonic()
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+    def _run(self, args, input, timeout, kwargs):
+        timeout = self._time_limit(timeout)
+        if timeout is not None and timeout <= 0:
+            # 全体の制限時間を過ぎたものは起動しない
+            return ProcessResult(args, None, b'', b'', True, 0.0)
+        start = monotonic()
+        try:
+            proc = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                **kwargs)
+        except OSError as e:
+            # 起動できなかったコマンドもほかと同じく結果として返し、
+            # run_all()の残りのコマンドは続ける。終了コードはNone
+            return ProcessResult(args, None, b'', str(e).encode(), False,
+                                 monotonic() - start)
+        timed_out = False
+        try:
+            out, err = proc.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            stop_process(proc, self.grace)
+            try:
+                out, err = proc.communicate(timeout=self.grace)
+            except subprocess.TimeoutExpired:
+                # 孫プロセスがパイプを開いたままのときは読むのをあきらめる
+                out, err = b'', b''
+                proc.stdout.close()
+                proc.stderr.close()
+        except BaseException:
+            stop_process(proc, self.grace)
+            raise
+        return ProcessResult(args, proc.returncode, out, err, timed_out,
+                             monotonic() - start)
+
+    def submit(self, args, input=None, timeout=None, **kwargs):
+        """argsをいずれ実行する。kwargsはそのままPopenに渡す"""
+        return self.executor.submit(self._run, args, input, timeout, kwargs)
+
+    def run_all(self, commands, timeout=None):
+        """commandsをすべて実行し、終わったものから順にProcessResultを返す"""
+        futures = [self.submit(args, timeout=timeout) for args in commands]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+start = time()
+with SubprocessPool(max_procs=10) as pool:
+    results = list(pool.run_all(['sleep', '0.1'] for _ in range(100)))
+end = time()
+print('Ran %d processes, 10 at a time, in %.3f seconds' % (
+    len(results), end - start))
+
+"""
+TERMを無視するプロセスはgrace秒後にkillされる。
+全体の制限時間を過ぎたあとのコマンドは起動されない
+"""
+commands = [
+    ['sleep', '10'],
+    ['sh', '-c', 'trap "" TERM; sleep 10'],
+    ['echo', 'done'],
+    ['sleep', '10'],
+    ['echo', 'too late'],
+]
+with SubprocessPool(max_procs=2, timeout=0.2, deadline=0.3,
+                    grace=0.2) as pool:
+    for result in pool.run_all(commands):
+        print(result.args, result.returncode, result.stdout,
+              'timed out' if result.timed_out else '')
+
+# 起動できないコマンドがあっても残りは実行される
+with SubprocessPool(max_procs=1) as pool:
+    for result in pool.run_all([['no-such-command'], ['echo', 'still runs']]):
+        print(result.args, result.returncode, result.stderr or result.stdout)
+"""
+> Ran 100 processes, 10 at a time, in 1.048 seconds
+> ['sleep', '10'] -15 b'' timed out
+> ['echo', 'done'] 0 b'done\n'
+> ['sleep', '10'] -15 b'' timed out
+> ['echo', 'too late'] None b'' timed out
+> ['sh', '-c', 'trap "" TERM; sleep 10'] -9 b'' timed out
+> ['no-such-command'] None b"[Errno 2] No such file or directory: 'no-such-command'"
+> ['echo', 'still runs'] 0 b'still runs\n'
+"""
+
+
+"""
+最初のwhile proc.poll() is None:のループは、子プロセスが終わるまで
+CPUを100%使い続ける。ChildWatcherはselectorsで子プロセスの終了と出力を
+まとめて待つ。終了はpidfd(Linux 5.3以降)で、子プロセスが終わると
+読み込み可能になるファイルディスクリプタとして待てる。pidfdがない環境では
+proc.wait()するスレッドがソケットに書き込んで知らせる。
+イベントが起きるまで眠っているので、何百個の子プロセスを見ていてもCPUを使わない。
+"""
+import selectors
+import socket
+import threading
+
+class ChildWatcher(object):
+    """add()した子プロセスの出力と終了をevents()で受け取る"""
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.running = 0
+
+    def add(self, proc):
+        for kind in ('stdout', 'stderr'):
+            pipe = getattr(proc, kind)
+            if pipe is not None:
+                os.set_blocking(pipe.fileno(), False)
+                self.selector.register(pipe, selectors.EVENT_READ,
+                                       (proc, kind))
+        if hasattr(os, 'pidfd_open'):
+            exit_fd = os.pidfd_open(proc.pid)
+        else:
+            exit_fd, notify = socket.socketpair()
+            threading.Thread(target=self._wait_in_thread,
+                             args=(proc, notify), daemon=True).start()
+        self.selector.register(exit_fd, selectors.EVENT_READ, (proc, 'exit'))
+        self.running += 1
+
+    def _wait_in_thread(self, proc, notify):
+        proc.wait()
+        notify.close() # 相手のソケットが読み込み可能(EOF)になる
+
+    def events(self, timeout=None):
+        """(proc, 'stdout'か'stderr', 読んだバイト列)と(proc, 'exit', 終了コード)を
+        起きた順に返すジェネレータ。子プロセスがすべて終わるか、
+        timeout秒の間何も起きなければ終わる。出力は終了のあとに届くこともある
+        """
+        while self.selector.get_map():
+            ready = self.selector.select(timeout)
+            if not ready:
+                return
+            for key, _ in ready:
+                proc, kind = key.data
+                if kind == 'exit':
+                    self.selector.unregister(key.fileobj)
+                    if isinstance(key.fileobj, int):
+                        os.close(key.fileobj)
+                    else:
+                        key.fileobj.close()
+                    self.running -= 1
+                    yield proc, kind, proc.wait()
+                    continue
+                data = os.read(key.fd, 65536)
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                yield proc, kind, data
+
+    def close(self):
+        self.selector.close()
+
+
+from time import process_time
+cpu_start = process_time()
+proc = subprocess.Popen(['sleep', '0.3'])
+loops = 0
+while proc.poll() is None:
+    loops += 1
+print('poll(): %d loops, %.3f CPU seconds' % (loops, process_time() - cpu_start))
+
+cpu_start = process_time()
+watcher = ChildWatcher()
+watcher.add(subprocess.Popen(['sleep', '0.3']))
+for proc, kind, value in watcher.events():
+    print('ChildWatcher: %s %r, %.3f CPU seconds' % (
+        kind, value, process_time() - cpu_start))
+watcher.close()
+
+"""
+200個の子プロセスを監視する。出力があればすぐに起きて受け取る
+"""
+start = time()
+cpu_start = process_time()
+watcher = ChildWatcher()
+for i in range(200):
+    watcher.add(subprocess.Popen(
+        ['sh', '-c', 'sleep 0.5; echo %d; sleep 0.5' % i],
+        stdout=subprocess.PIPE))
+outputs = exits = 0
+for proc, kind, value in watcher.events():
+    if kind == 'exit':
+        exits += 1
+    else:
+        outputs += 1
+watcher.close()
+print('%d outputs, %d exits in %.3f seconds, %.3f CPU seconds' % (
+    outputs, exits, time() - start, process_time() - cpu_start))
+"""
+> poll(): 370466 loops, 0.300 CPU seconds
+> ChildWatcher: exit 0, 0.001 CPU seconds
+> 200 outputs, 200 exits in 1.485 seconds, 0.082 CPU seconds
+
+CPU時間のほとんどは200回のfork。
+"""
+
+
+"""
+asyncioならasyncio.create_subprocess_execで同じことができる。
+子プロセスごとのコルーチンが出力を1行ずつ読み、終了を待つ。
+イベントループが眠っている間はCPUを使わない
+"""
+import asyncio
+
+async def watch_child(args, on_output):
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE)
+    async for line in proc.stdout:
+        on_output(proc, line)
+    return await proc.wait()
+
+async def watch_children(commands, on_output):
+    """commandsを同時に実行し、終了コードのリストを返す"""
+    return await asyncio.gather(*[watch_child(args, on_output)
+                                  for args in commands])
+
+start = time()
+cpu_start = process_time()
+lines = []
+returncodes = asyncio.run(watch_children(
+    [['sh', '-c', 'sleep 0.5; echo %d; sleep 0.5' % i] for i in range(200)],
+    lambda proc, line: lines.append(line)))
+print('%d outputs, %d exits in %.3f seconds, %.3f CPU seconds' % (
+    len(lines), returncodes.count(0), time() - start,
+    process_time() - cpu_start))
+"""
+> 200 outputs, 200 exits in 1.665 seconds, 0.180 CPU seconds
+
+Python 3.11のasyncioは子プロセスごとにwaitpid()するスレッドを作るので、
+ChildWatcherより少し重い。3.12からはpidfdで待つようになる。
+"""
+
+
+"""
+run_openssl()はデータをstdinに一度に書き、communicate()は出力をすべて
+メモリにためるので、大きなデータは扱えない。ProcessChainはコマンドを
+パイプでつなぎ、入力のイテレータからchunk_sizeずつ別スレッドで先頭に書き込み、
+最後の出力をchunk_sizeずつ読んで返す。書く側と読む側が別なので、
+パイプのバッファがいっぱいになってもお互いを待ち合ってデッドロックしない。
+途中の段階どうしはOSのパイプで直接つながり、Pythonを通らない。
+"""
+import hashlib
+import signal
+
+class ProcessChain(object):
+    """commandsをシェルの|のようにつないで実行する"""
+    def __init__(self, commands, chunk_size=64 * 1024, stderr=None):
+        self.commands = commands
+        self.chunk_size = chunk_size
+        self.stderr = stderr
+
+    def _start(self):
+        procs = []
+        stdin = subprocess.PIPE
+        try:
+            for args in self.commands:
+                proc = subprocess.Popen(args, stdin=stdin,
+                                        stdout=subprocess.PIPE,
+                                        stderr=self.stderr)
+                if procs:
+                    # 親が読み口を持ったままだと、前の段階が終わってもEOFにならない
+                    procs[-1].stdout.close()
+                procs.append(proc)
+                stdin = proc.stdout
+        except BaseException:
+            # 途中のコマンドが起動できなければ、起動済みの段階を止めて待つ
+            for proc in procs:
+                proc.kill()
+                for pipe in (proc.stdin, proc.stdout):
+                    if pipe is not None:
+                        pipe.close()
+                proc.wait()
+            raise
+        return procs
+
+    def _feed(self, pipe, chunks, errors):
+        try:
+            buffer = bytearray()
+            for chunk in chunks:
+                buffer += chunk
+                while len(buffer) >= self.chunk_size:
+                    pipe.write(buffer[:self.chunk_size])
+                    del buffer[:self.chunk_size]
+            pipe.write(buffer)
+        except BrokenPipeError:
+            pass # 先頭のコマンドが入力を読まずに終わった。終了コードで報告する
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+
+    def iter_output(self, chunks):
+        """chunksを流し、最後のコマンドの出力をchunk_sizeずつ返すジェネレータ。
+        どれかのコマンドが失敗したらCalledProcessErrorを送出する
+        """
+        procs = self._start()
+        errors = []
+        feeder = threading.Thread(target=self._feed,
+                                  args=(procs[0].stdin, chunks, errors))
+        feeder.start()
+        finished = False
+        try:
+            while True:
+                chunk = procs[-1].stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            finished = True
+        finally:
+            procs[-1].stdout.close()
+            for proc in procs:
+                if not finished and proc.poll() is None:
+                    proc.kill() # 途中でやめたときは残りを止める
+                proc.wait()
+            feeder.join()
+        if errors:
+            raise errors[0]
+        # 失敗したうちで一番後ろのコマンドを報告する。後ろが先に読むのを
+        # やめたせいでSIGPIPEで終わった前の段階は失敗とみなさない
+        last = len(procs) - 1
+        for i in range(last, -1, -1):
+            returncode = procs[i].returncode
+            if returncode and (i == last or returncode != -signal.SIGPIPE):
+                raise subprocess.CalledProcessError(returncode,
+                                                    self.commands[i])
+
+    def copy_to(self, chunks, fileobj):
+        """出力をfileobjに書き、書いたバイト数を返す"""
+        size = 0
+        for chunk in self.iter_output(chunks):
+            fileobj.write(chunk)
+            size += len(chunk)
+        return size
+
+    def hexdigest(self, chunks, name='md5'):
+        """出力をためずにハッシュして16進数の文字列で返す"""
+        digest = hashlib.new(name)
+        for chunk in self.iter_output(chunks):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def random_chunks(size, chunk_size=1024 * 1024):
+    while size > 0:
+        yield os.urandom(min(size, chunk_size))
+        size -= chunk_size
+
+data = os.urandom(3 * 1024 * 1024 + 1)
+chain = ProcessChain([['cat'], ['md5sum']])
+out = b''.join(chain.iter_output(
+    data[i:i + 1000] for i in range(0, len(data), 1000)))
+assert out.split()[0].decode() == hashlib.md5(data).hexdigest()
+
+# 途中のコマンドが起動できなければ、起動済みのcatを止めてから例外を送出する
+try:
+    b''.join(ProcessChain([['cat'], ['no-such-command']]).iter_output([data]))
+except FileNotFoundError as e:
+    print(e)
+
+"""
+32MBを暗号化してmd5でハッシュし、128MBをcat | catに通す。データを1MBずつ
+作って流すので、プロセスのメモリはデータより小さいまま増えない
+"""
+import resource
+size = 32 * 1024 ** 2
+chain = ProcessChain([
+    ['openssl', 'enc', '-des3', '-pbkdf2', '-pass', 'pass:password'],
+    ['md5sum']], stderr=subprocess.DEVNULL)
+start = time()
+out = b''.join(chain.iter_output(random_chunks(size)))
+end = time()
+print(out.strip())
+print('%.1f MB/s, max RSS %.1f MB' % (
+    size / (end - start) / 1024 ** 2,
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+start = time()
+size = 128 * 1024 ** 2
+digest = ProcessChain([['cat'], ['cat']]).hexdigest(random_chunks(size))
+end = time()
+print('cat | cat: %.1f MB/s, max RSS %.1f MB' % (
+    size / (end - start) / 1024 ** 2,
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+"""
+> [Errno 2] No such file or directory: 'no-such-command'
+> b'56590a5d14668b6c6d95d5e3d9f5f39d  -'
+> 19.4 MB/s, max RSS 29.5 MB
+> cat | cat: 176.3 MB/s, max RSS 29.5 MB
+
+データの大きさによらずメモリは一定。速さはopensslのdes3と、
+1コアで親と子が交互に動くパイプのコピーで決まる。
+"""
+
+
+"""
+小さなデータのmd5のためにmd5sumをforkすると、ハッシュの計算よりも
+プロセスの起動のほうがずっと時間がかかる。HashBackendはhashlibで
+プロセスの中でハッシュを求め、データが大きくて数が多いときはスレッドプールで
+並列に計算する。hashlibは2047バイトより大きいデータではGILを解放する。
+hashlibにないアルゴリズムだけ、今までどおりコマンドを起動する。
+"""
+class HashBackend(object):
+    """hash_many()でpayloadsのハッシュを16進数の文字列のリストで返す"""
+    THREAD_MIN_SIZE = 256 * 1024 # これより小さいとスレッドに渡す手間のほうが大きい
+    THREAD_MIN_BATCH = 2
+    COMMANDS = {
+        'md5': ['md5sum'],
+        'sha1': ['sha1sum'],
+        'sha256': ['sha256sum'],
+    }
+
+    def __init__(self, name='md5', max_workers=None, command=None):
+        """commandを指定するか、hashlibにないアルゴリズムならコマンドを起動する"""
+        self.name = name
+        self.max_workers = max_workers or os.cpu_count()
+        if command is None and name not in hashlib.algorithms_available:
+            command = self.COMMANDS.get(
+                name, ['openssl', 'dgst', '-' + name, '-r'])
+        self.command = command
+
+    def hash_one(self, data):
+        return hashlib.new(self.name, data).hexdigest()
+
+    def choose(self, payloads):
+        """payloadsをどの方法でハッシュするか決める"""
+        if self.command is not None:
+            return 'subprocess'
+        if (len(payloads) >= self.THREAD_MIN_BATCH and self.max_workers > 1 and
+                sum(map(len, payloads)) / len(payloads) >= self.THREAD_MIN_SIZE):
+            return 'thread'
+        return 'serial'
+
+    def hash_many(self, payloads, method=None):
+        payloads = list(payloads)
+        method = method or self.choose(payloads)
+        if method == 'serial':
+            return [self.hash_one(data) for data in payloads]
+        if method == 'thread':
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return list(executor.map(self.hash_one, payloads))
+        if method == 'subprocess':
+            return self._hash_subprocess(payloads)
+        raise ValueError('Unknown method: %r' % method)
+
+    def _hash_subprocess(self, payloads):
+        command = self.command or self.COMMANDS[self.name]
+        with SubprocessPool(max_procs=self.max_workers) as pool:
+            futures = [pool.submit(command, input=data) for data in payloads]
+            digests = []
+            for future in futures:
+                result = future.result()
+                if result.returncode:
+                    raise subprocess.CalledProcessError(
+                        result.returncode, command, result.stdout,
+                        result.stderr)
+                digests.append(result.stdout.split()[0].decode())
+            return digests
+
+
+"""
+同じデータをmd5sumを起動する方法とhashlibで比べる
+"""
+backend = HashBackend(max_workers=4)
+for size, count in ((10, 200), (64 * 1024, 200), (4 * 1024 ** 2, 25)):
+    payloads = [os.urandom(size) for _ in range(count)]
+    timings = {}
+    for method in ('subprocess', 'serial', 'thread'):
+        start = time()
+        digests = backend.hash_many(payloads, method)
+        timings[method] = time() - start
+        assert digests == [hashlib.md5(data).hexdigest() for data in payloads]
+    print('%8d bytes x %3d: chosen %-7s  md5sum %6.0f forks/s %8.1f MB/s, '
+          'hashlib %8.1f MB/s, threads %8.1f MB/s' % (
+        size, count, backend.choose(payloads),
+        count / timings['subprocess'],
+        size * count / timings['subprocess'] / 1024 ** 2,
+        size * count / timings['serial'] / 1024 ** 2,
+        size * count / timings['thread'] / 1024 ** 2))
+"""
+>       10 bytes x 200: chosen serial   md5sum    675 forks/s      0.0 MB/s, hashlib     11.4 MB/s, threads      0.6 MB/s
+>    65536 bytes x 200: chosen serial   md5sum    583 forks/s     36.5 MB/s, hashlib    458.3 MB/s, threads    433.4 MB/s
+>  4194304 bytes x  25: chosen thread   md5sum     77 forks/s    306.3 MB/s, hashlib    567.4 MB/s, threads    548.8 MB/s
+
+小さいデータではforkの回数で速さが決まり、hashlibとは1000倍違う。
+1コアのマシンなのでスレッドは速くならないが、コアがあれば大きなデータで効く。
+"""
@@ -11,11 +11,12 @@ def factorize(number):
 
 from time import time
 numbers = [5354123, 2123543, 1421443, 5423123]
-start = time()
-for number in numbers:
-    list(factorize(number))
-end = time()
-print('Took %.3f seconds' % (end - start)) # Took 1.176 seconds
+if __name__ == '__main__':
+    start = time()
+    for number in numbers:
+        list(factorize(number))
+    end = time()
+    print('Took %.3f seconds' % (end - start)) # Took 1.176 seconds
 
 
 """
@@ -31,21 +32,96 @@ class FactorizeThread(Thread):
     def run(self):
         self.factors = list(factorize(self.number))
 
-start = time()
-threads = []
-for number in numbers:
-    thread = FactorizeThread(number)
-    thread.start()
-    threads.append(thread)
+if __name__ == '__main__':
+    start = time()
+    threads = []
+    for number in numbers:
+        thread = FactorizeThread(number)
+        thread.start()
+        threads.append(thread)
 
-# すべてのスレッドが終わるのを待つ
-for thread in threads:
-    thread.join()
+    # すべてのスレッドが終わるのを待つ
+    for thread in threads:
+        thread.join()
 
-end = time()
-print('Took %.3f seconds' % (end - start)) # Took 1.505 seconds
+    end = time()
+    print('Took %.3f seconds' % (end - start)) # Took 1.505 seconds
 
 
 """
 遅くなった。スレッドを作成し、同期するためのオーバーヘッドのせい。
-"""
\ No newline at end of file
+"""
+
+"""
+そもそもfactorize()はnumberまで全部割ってみるので遅い。約数は平方根の
+前後で組になるので、平方根まで調べれば十分。factorization.pyにまとめた
+"""
+from factorization import divisors, factorize_many, prime_factors
+
+if __name__ == '__main__':
+    for number in numbers:
+        assert list(divisors(number)) == list(factorize(number))
+
+    start = time()
+    for number in numbers:
+        list(divisors(number))
+    end = time()
+    print('Took %.3f seconds' % (end - start))
+    for number in numbers:
+        print(number, prime_factors(number))
+
+"""
+たくさんの数を分解するときは、GILに縛られないプロセスプールで
+コアの数だけ並列に計算する
+"""
+import os
+import random
+
+if __name__ == '__main__':
+    batch = [random.randint(10**9, 10**10) for _ in range(400)]
+    start = time()
+    serial = [list(divisors(number)) for number in batch]
+    end = time()
+    print('Serial: took %.3f seconds' % (end - start))
+    start = time()
+    parallel = factorize_many(batch)
+    end = time()
+    assert parallel == serial
+    print('%d processes: took %.3f seconds' % (os.cpu_count(), end - start))
+
+"""
+> Took 0.000 seconds
+> 5354123 [5354123]
+> 2123543 [1187, 1789]
+> 1421443 [31, 45853]
+> 5423123 [5423123]
+> Serial: took 1.407 seconds
+> 1 processes: took 1.393 seconds
+1コアのマシンで計測したので並列化の効果は見えないが、
+コアがあればその数に比例して速くなる
+"""
+
+
+"""
+bench.pyで元のfactorize()を直列、スレッド、プロセス、asyncioの
+それぞれで計測する。time()を1回呼ぶだけより結果が安定する
+"""
+import bench
+
+def factorize_list(number):
+    return list(factorize(number))
+
+if __name__ == '__main__':
+    results = bench.run_modes('factorize', factorize_list, numbers,
+                              workers=len(numbers), warmup=1, repeat=3)
+    bench.report(results)
+"""
+> benchmark                mode     workers    min(s) median(s)    p90(s)    max(s)
+> factorize                serial         1    0.5869    0.6144    0.6147    0.6148
+> factorize                thread         4    0.6003    0.6030    0.7535    0.7912
+> factorize                process        4    0.6517    0.6611    0.6911    0.6986
+> factorize                asyncio        1    0.5832    0.6068    0.6296    0.6353
+
+1コアなのでどれも同じ。コアがあればprocessだけが速くなる。
+BENCH_SAVE=base.jsonで結果を保存し、BENCH_BASELINE=base.jsonで比べられる
+"""
@@ -77,31 +77,33 @@ class Worker(Thread):
                 self.work_done += 1
 
 
-download_queue = MyQueue()
-resize_queue = MyQueue()
-upload_queue = MyQueue()
-done_queue = MyQueue()
-threads = [
-    Worker(download, download_queue, resize_queue),
-    Worker(resize, resize_queue, upload_queue),
-    Worker(upload, upload_queue, done_queue),
-]
-
-
-for thread in threads:
-    thread.start()
-for _ in range(1000):
-    download_queue.put(object())
-
 import time
-while len(done_queue.items) < 1000:
-    # Do something useful while waiting
-    time.sleep(0.1)
 
+if __name__ == '__main__':
+    download_queue = MyQueue()
+    resize_queue = MyQueue()
+    upload_queue = MyQueue()
+    done_queue = MyQueue()
+    threads = [
+        Worker(download, download_queue, resize_queue),
+        Worker(resize, resize_queue, upload_queue),
+        Worker(upload, upload_queue, done_queue),
+    ]
+
+
+    for thread in threads:
+        thread.start()
+    for _ in range(1000):
+        download_queue.put(object())
 
-processed = len(done_queue.items)
-polled = sum(t.polled_count for t in threads)
-print('Processed', processed, 'items after polling', polled, 'times')
+    while len(done_queue.items) < 1000:
+        # Do something useful while waiting
+        time.sleep(0.1)
+
+
+    processed = len(done_queue.items)
+    polled = sum(t.polled_count for t in threads)
+    print('Processed', processed, 'items after polling', polled, 'times')
 """
 > Processed 1000 items after polling 3028 times
 
@@ -115,3 +117,920 @@ print('Processed', processed, 'items after polling', polled, 'times')
 パイプラインが悪いわけではなく、優れた生産者消費者キューを作ることが難しい。
 """
 
+"""
+threading.Conditionを使って、ブロックする生産者消費者キューを作る。
+
+- get()は要素が来るまで、put()は空きができるまでスレッドを眠らせるので
+  ポーリングがなくなり、CPUを使わずに待てて、要素が来たらすぐ起きる
+- maxsizeでキューの大きさに上限をつけると、後段が遅いときに前段のput()が
+  ブロックされて、パイプラインの速さが一番遅い段階にそろう
+- close()するとそれ以上putできなくなり、空になった後のget()はQueueClosedになる。
+  これで作業者スレッドは入力が尽きたら終了できる
+"""
+import itertools
+from queue import Empty, Full
+from threading import Condition
+
+class QueueClosed(Exception):
+    """close()されたキューにputした、または空になったキューからgetした。
+    put_many()ではaddedにそれまでに追加した要素の数が入る
+    """
+    added = 0
+
+class BlockingQueue(object):
+    def __init__(self, maxsize=0, lock=None):
+        """maxsizeが0以下なら上限なし。lockでLockの代わりを渡せる"""
+        self.items = deque()
+        self.maxsize = maxsize
+        self.closed = False
+        self.lock = Lock() if lock is None else lock
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def _full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def put(self, item, timeout=None):
+        """空きができるまで待って末尾に追加する。timeout秒待っても
+        空かなければqueue.Full、close()されていればQueueClosedを送出する
+        """
+        with self.not_full:
+            if not self.not_full.wait_for(
+                    lambda: self.closed or not self._full(), timeout):
+                raise Full
+            if self.closed:
+                raise QueueClosed
+            self.items.append(item)
+            self.not_empty.notify()
+
+    def get(self, timeout=None):
+        """要素が来るまで待って先頭から取り出す。timeout秒待っても
+        来なければqueue.Empty、close()されて空ならQueueClosedを送出する
+        """
+        with self.not_empty:
+            if not self.not_empty.wait_for(
+                    lambda: self.items or self.closed, timeout):
+                raise Empty
+            if not self.items:
+                raise QueueClosed
+            item = self.items.popleft()
+            self.not_full.notify()
+            return item
+
+    def get_many(self, n, timeout=None):
+        """要素が1つ以上来るまで待って、先頭から最大n個をリストで取り出す。
+        1回のロックでまとめて取り出すので、小さな要素ではget()より速い
+        """
+        with self.not_empty:
+            if not self.not_empty.wait_for(
+                    lambda: self.items or self.closed, timeout):
+                raise Empty
+            if not self.items:
+                raise QueueClosed
+            count = min(n, len(self.items))
+            items = [self.items.popleft() for _ in range(count)]
+            self.not_full.notify(count)
+            return items
+
+    def put_many(self, items, timeout=None):
+        """itemsを順に末尾に追加する。itemsはリストにせず少しずつ取り出し、
+        空きがある分だけまとめて追加して、足りなければ空くのを待つ。
+        要素はロックを持ったまま取り出すので、重い計算をするジェネレータは
+        渡さない。timeoutは全体の待ち時間で、queue.FullやQueueClosedに
+        なったときはそれまでの要素は追加済み
+        """
+        end = object()
+        iterator = iter(items)
+        item = next(iterator, end)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.not_full:
+            added = 0
+            while item is not end:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                if not self.not_full.wait_for(
+                        lambda: self.closed or not self._full(), remaining):
+                    raise Full
+                if self.closed:
+                    error = QueueClosed()
+                    error.added = added
+                    raise error
+                size = len(self.items)
+                self.items.append(item)
+                free = None
+                if self.maxsize > 0:
+                    free = self.maxsize - len(self.items)
+                self.items.extend(itertools.islice(iterator, free))
+                count = len(self.items) - size
+                added += count
+                self.not_empty.notify(count)
+                # 次の要素を先に取り出し、残りがなければ空きを待たずに終わる
+                item = next(iterator, end)
+
+    def close(self):
+        """待っているスレッドをすべて起こす。残っている要素はgetできる"""
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def __iter__(self):
+        """close()されて空になるまで要素を取り出す"""
+        while True:
+            try:
+                yield self.get()
+            except QueueClosed:
+                return
+
+
+class StoppableWorker(Thread):
+    """入力のキューがclose()されて空になったら終了する作業者スレッド"""
+    def __init__(self, func, in_queue, out_queue):
+        super().__init__()
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.work_done = 0
+
+    def run(self):
+        for item in self.in_queue:
+            result = self.func(item)
+            self.out_queue.put(result)
+            self.work_done += 1
+
+
+if __name__ == '__main__':
+    download_queue = BlockingQueue(maxsize=10)
+    resize_queue = BlockingQueue(maxsize=10)
+    upload_queue = BlockingQueue(maxsize=10)
+    done_queue = BlockingQueue()
+    threads = [
+        StoppableWorker(download, download_queue, resize_queue),
+        StoppableWorker(resize, resize_queue, upload_queue),
+        StoppableWorker(upload, upload_queue, done_queue),
+    ]
+
+    for thread in threads:
+        thread.start()
+    for _ in range(1000):
+        download_queue.put(object()) # 10個たまるとここで待たされる
+
+    # 前の段階から順にcloseして終了を待つ。ポーリングはしない
+    download_queue.close()
+    threads[0].join()
+    resize_queue.close()
+    threads[1].join()
+    upload_queue.close()
+    threads[2].join()
+
+    print('Processed', len(done_queue), 'items without polling')
+"""
+> Processed 1000 items without polling
+"""
+
+if __name__ == '__main__':
+    try:
+        BlockingQueue().get(timeout=0.01)
+    except Empty:
+        print('Timed out waiting for an item')
+
+
+"""
+段階ごとに作業者スレッドの数を決められるパイプラインを組み立てる。
+
+段階の最後のスレッドが終わったら出力キューをclose()するので、
+パイプラインの入口をclose()すればclose()が順に伝わって全スレッドが終了する。
+join()はスレッドのjoin()を待つだけでポーリングしない。
+同じ段階の複数のスレッドが並列に処理するので、出力の順番は入力と同じとは限らない。
+"""
+class StageWorker(Thread):
+    """入力が尽きたらStageに終了を知らせる作業者スレッド。
+    計測値は自分のスレッドだけが書き込むので、ロックなしで記録できる
+    """
+    def __init__(self, stage):
+        super().__init__()
+        self.stage = stage
+        self.work_done = 0
+        self.wait_seconds = 0.0
+        self.service_seconds = 0.0
+        self.blocked_seconds = 0.0
+
+    def run(self):
+        stage = self.stage
+        try:
+            while stage.error is None:
+                begin = time.perf_counter()
+                try:
+                    items = stage.in_queue.get_many(stage.batch_size or 1)
+                except QueueClosed:
+                    break
+                got = time.perf_counter()
+                try:
+                    if stage.batch_size is None:
+                        results = [stage.call(items[0])]
+                    else:
+                        results = stage.call(items)
+                except Exception:
+                    stage.leave(items)
+                    raise
+                served = time.perf_counter()
+                try:
+                    stage.out_queue.put_many(results)
+                except QueueClosed as e:
+                    # 後ろの段階が失敗して止まった。前の段階にも止まるよう伝える
+                    stage.leave(results[e.added:])
+                    stage.in_queue.close()
+                    break
+                self.wait_seconds += got - begin
+                self.service_seconds += served - got
+                self.blocked_seconds += time.perf_counter() - served
+                self.work_done += len(items)
+        except Exception as e:
+            stage.fail(e)
+        finally:
+            stage.worker_done()
+
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import bench # forkserverの文脈を返すprocess_context()はbench.pyと共有する
+StageMetrics = collections.namedtuple('StageMetrics', (
+    'name', 'workers', 'queue_depth', 'items', 'items_per_second',
+    'wait_seconds', 'service_seconds', 'blocked_seconds'))
+
+
+class Stage(object):
+    """パイプラインの1段階。workers個のスレッドでin_queueを処理する。
+    batch_sizeを指定するとfuncは最大batch_size個の要素のリストを受け取り、
+    結果のリストを返す。processesが真ならfuncはworkers個のプロセスの
+    プールで実行され、各スレッドはその結果を待つだけになる
+    """
+    def __init__(self, func, workers, in_queue, out_queue, batch_size=None,
+                 processes=False):
+        self.func = func
+        self.batch_size = batch_size
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.lock = Lock()
+        self.running = workers
+        self.error = None
+        self.leftovers = [] # 失敗したせいで次に渡せなかった要素
+        self.threads = [StageWorker(self) for _ in range(workers)]
+        self.executor = None
+        if processes:
+            # ほかのスレッドがロックを持っている最中にforkすると、子プロセスでは
+            # そのロックが解放されなくなる。スレッドのないforkserverから
+            # 子プロセスを作る。子プロセスはこのスクリプトをimportし直すので、
+            # 例はif __name__ == '__main__':の中に置く
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=bench.process_context())
+        self.started = time.perf_counter()
+        self.finished = None # 最後のスレッドが終わった時刻
+
+    def call(self, arg):
+        if self.executor is None:
+            return self.func(arg)
+        return self.executor.submit(self.func, arg).result()
+
+    def metrics(self):
+        """その時点の計測値。wait_secondsは入力を待った時間、service_secondsは
+        funcの実行時間、blocked_secondsは出力キューの空きを待った時間の
+        スレッドごとの合計。入力を待たずに働き続けている段階がボトルネック
+        """
+        items = sum(t.work_done for t in self.threads)
+        finished = self.finished
+        if finished is None:
+            finished = time.perf_counter()
+        elapsed = finished - self.started
+        return StageMetrics(
+            name=self.func.__name__,
+            workers=len(self.threads),
+            queue_depth=len(self.in_queue),
+            items=items,
+            items_per_second=items / elapsed if elapsed else 0.0,
+            wait_seconds=sum(t.wait_seconds for t in self.threads),
+            service_seconds=sum(t.service_seconds for t in self.threads),
+            blocked_seconds=sum(t.blocked_seconds for t in self.threads))
+
+    def leave(self, items):
+        """funcが失敗したときの入力や、次の段階が止まって渡せなかった結果を
+        Pipeline.join()が片付けられるように覚えておく
+        """
+        with self.lock:
+            self.leftovers.extend(items)
+
+    def fail(self, error):
+        """funcが例外を送出した。最初の例外を覚えておき、入力のキューを
+        close()して前の段階のput()をQueueClosedにし、出力のキューも
+        close()して後ろの段階を終わらせる
+        """
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.in_queue.close()
+        self.out_queue.close()
+
+    def worker_done(self):
+        """最後のスレッドが終わったら次の段階にclose()を伝える"""
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            self.finished = time.perf_counter()
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.out_queue.close()
+
+
+class Pipeline(object):
+    """add_stage()で段階を追加してstart()する。段階の間のキューは
+    maxsizeで上限をつける。最後の出力キューは上限なしなので、
+    結果を読まずにjoin()してもブロックしない。discardを渡すと、
+    段階が失敗したときに処理されずに残った要素をjoin()がdiscard(item)に渡す
+    """
+    def __init__(self, maxsize=10, discard=None):
+        self.maxsize = maxsize
+        self.discard = discard
+        self.in_queue = BlockingQueue(maxsize)
+        self.out_queue = None
+        self.specs = []
+        self.stages = []
+
+    def add_stage(self, func, workers=1, batch_size=None, processes=False):
+        """processesが真ならfuncをプロセスのプールで実行する。
+        funcと要素はpickleできる必要がある
+        """
+        self.specs.append((func, workers, batch_size, processes))
+        return self
+
+    def start(self):
+        in_queue = self.in_queue
+        for i, (func, workers, batch_size, processes) in enumerate(self.specs):
+            last = i == len(self.specs) - 1
+            out_queue = BlockingQueue(0 if last else self.maxsize)
+            self.stages.append(Stage(
+                func, workers, in_queue, out_queue, batch_size, processes))
+            in_queue = out_queue
+        self.out_queue = in_queue
+        for stage in self.stages:
+            for thread in stage.threads:
+                thread.start()
+        return self
+
+    def put(self, item):
+        """段階のどれかが失敗して止まっているとQueueClosedを送出する"""
+        self.in_queue.put(item)
+
+    def put_many(self, items):
+        self.in_queue.put_many(items)
+
+    def metrics(self):
+        return [stage.metrics() for stage in self.stages]
+
+    def close(self):
+        """入力の終わりを知らせる"""
+        self.in_queue.close()
+
+    def join(self):
+        """全スレッドの終了を待つ。どこかの段階でfuncが例外を送出していたら、
+        残った要素をdiscardに渡してから、一番前の段階の例外を送出する。
+        最後の出力キューの結果は片付けないので、そのまま取り出せる
+        """
+        for stage in self.stages:
+            for thread in stage.threads:
+                thread.join()
+        errors = [stage.error for stage in self.stages
+                  if stage.error is not None]
+        if not errors:
+            return
+        if self.discard is not None:
+            for stage in self.stages:
+                for item in stage.leftovers:
+                    self.discard(item)
+                stage.leftovers = []
+                for item in stage.in_queue: # close()済みなので空になれば止まる
+                    self.discard(item)
+        raise errors[0]
+
+    def __iter__(self):
+        """結果を出てきた順に取り出す。close()が伝わり終わると止まる"""
+        return iter(self.out_queue)
+
+
+"""
+resizeだけが遅いとき、resizeのスレッドを増やせば全体もその分速くなる
+"""
+def slow_resize(item):
+    sleep(0.01) # 画像の変換の代わり。sleepの間はGILを手放す
+    return item
+
+if __name__ == '__main__':
+    for resize_workers in (1, 8):
+        pipeline = Pipeline(maxsize=10)
+        pipeline.add_stage(download, workers=2)
+        pipeline.add_stage(slow_resize, workers=resize_workers)
+        pipeline.add_stage(upload, workers=2)
+        pipeline.start()
+
+        start = time.time()
+        for _ in range(200):
+            pipeline.put(object())
+        pipeline.close()
+        pipeline.join()
+        end = time.time()
+        print('%d resize workers: processed %d items in %.3f seconds' % (
+            resize_workers, len(list(pipeline)), end - start))
+"""
+> 1 resize workers: processed 200 items in 2.040 seconds
+> 8 resize workers: processed 200 items in 0.255 seconds
+"""
+
+
+"""
+段階のfuncが例外を送出すると、その段階は入力と出力のキューをclose()する。
+前の段階とパイプラインのput()はQueueClosedになり、join()が例外を送出する
+"""
+def broken_upload(item):
+    raise ValueError('upload failed')
+
+if __name__ == '__main__':
+    pipeline = Pipeline(maxsize=2)
+    pipeline.add_stage(download, workers=2)
+    pipeline.add_stage(broken_upload)
+    pipeline.start()
+    try:
+        for _ in range(100):
+            pipeline.put(object())
+        pipeline.close()
+    except QueueClosed:
+        print('Pipeline stopped accepting items')
+    try:
+        pipeline.join()
+    except ValueError as e:
+        print('join() raised', repr(e))
+"""
+> Pipeline stopped accepting items
+> join() raised ValueError('upload failed')
+"""
+
+
+"""
+小さな要素を1つずつ受け渡すと、要素ごとのロックと通知のコストが支配的になる。
+get_many()とput_many()で、まとめて受け渡す
+"""
+def resize_batch(items):
+    return [resize(item) for item in items]
+
+if __name__ == '__main__':
+    for batch_size in (None, 100):
+        pipeline = Pipeline(maxsize=1000)
+        if batch_size is None:
+            pipeline.add_stage(resize, workers=2)
+        else:
+            pipeline.add_stage(resize_batch, workers=2, batch_size=batch_size)
+        pipeline.start()
+
+        start = time.time()
+        items = [object() for _ in range(100000)]
+        for i in range(0, len(items), 1000):
+            pipeline.put_many(items[i:i + 1000])
+        pipeline.close()
+        pipeline.join()
+        end = time.time()
+        print('Batch size %s: %.3f seconds' % (batch_size, end - start))
+        for metrics in pipeline.metrics():
+            print('  %s: %d items, %.0f items/sec, wait %.3fs, '
+                  'service %.3fs, blocked %.3fs' % (
+                      metrics.name, metrics.items, metrics.items_per_second,
+                      metrics.wait_seconds, metrics.service_seconds,
+                      metrics.blocked_seconds))
+"""
+> Batch size None: 0.386 seconds
+>   resize: 100000 items, 259024 items/sec, wait 0.563s, service 0.021s, blocked 0.168s
+> Batch size 100: 0.023 seconds
+>   resize_batch: 100000 items, 4396855 items/sec, wait 0.038s, service 0.004s, blocked 0.003s
+
+1つずつだと時間のほとんどはfuncではなくキューの受け渡し(wait, blocked)に使われている
+"""
+
+
+"""
+スレッドの段階はGILのためCPUを使うresizeで1コアしか使えない。
+processes=Trueの段階はプロセスのプールでfuncを実行する。
+ただし画像のような大きなデータをそのまま渡すと、プールに送るときと
+結果を受け取るときの2回pickleされる。データはmultiprocessing.shared_memoryに置き、
+キューとプールには名前と大きさだけの小さなハンドルを流す。
+"""
+from multiprocessing import shared_memory
+SharedBuffer = collections.namedtuple('SharedBuffer', ('name', 'size'))
+
+def to_shared(data):
+    """dataを新しい共有メモリにコピーしてハンドルを返す"""
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    shm.buf[:len(data)] = data
+    shm.close()
+    return SharedBuffer(shm.name, len(data))
+
+def discard_shared(item):
+    """Pipelineのdiscardに渡す。処理されずに残ったSharedBufferの共有メモリを消す"""
+    if not isinstance(item, SharedBuffer):
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=item.name)
+    except FileNotFoundError:
+        return # 失敗したfuncがもう消していた
+    shm.close()
+    shm.unlink()
+
+def from_shared(handle):
+    """ハンドルの共有メモリの内容をbytesで取り出して共有メモリを消す"""
+    shm = shared_memory.SharedMemory(name=handle.name)
+    try:
+        return bytes(shm.buf[:handle.size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class SharedMemoryFunc(object):
+    """bytes風のオブジェクトを受け取ってbytes風のオブジェクトを返すfuncを、
+    SharedBufferを受け取ってSharedBufferを返す関数にする。
+    入力の共有メモリはfuncを呼んだ後に消す
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+
+    def __call__(self, handle):
+        shm = shared_memory.SharedMemory(name=handle.name)
+        try:
+            view = shm.buf[:handle.size]
+            try:
+                result = to_shared(self.func(view))
+            finally:
+                view.release()
+        finally:
+            shm.close()
+            shm.unlink()
+        return result
+
+
+def download_image(item):
+    return to_shared(os.urandom(256 * 1024))
+
+def resize_image(data):
+    """CPUを使う変換の代わり"""
+    return bytes(b >> 1 for b in data)
+
+def upload_image(handle):
+    return len(from_shared(handle))
+
+import os
+if __name__ == '__main__':
+    for processes in (False, True):
+        pipeline = Pipeline(maxsize=4)
+        pipeline.add_stage(download_image, workers=1)
+        pipeline.add_stage(SharedMemoryFunc(resize_image), workers=4,
+                           processes=processes)
+        pipeline.add_stage(upload_image, workers=1)
+        pipeline.start()
+
+        start = time.time()
+        for _ in range(40):
+            pipeline.put(object())
+        pipeline.close()
+        pipeline.join()
+        end = time.time()
+        print('%s: uploaded %d bytes in %.3f seconds' % (
+            'processes' if processes else 'threads  ',
+            sum(pipeline), end - start))
+"""
+1コアのマシンで計測。processesはforkserverから子プロセスを起動して
+このスクリプトをimportし直す時間も含むので遅くなる
+> threads  : uploaded 10485760 bytes in 0.610 seconds
+> processes: uploaded 10485760 bytes in 1.199 seconds
+
+コアがあればprocessesはresize_imageをworkers個まで同時に進められる。
+キューとプールを通るのはSharedBufferだけで、256KBのデータはpickleされない。
+"""
+
+"""
+途中の段階が失敗すると、キューや処理中に残ったSharedBufferは誰にも
+読まれない。discard_sharedを渡すと、join()がその共有メモリを消す
+"""
+def shared_segments():
+    """Linuxで今ある共有メモリの名前の集合"""
+    if not os.path.isdir('/dev/shm'):
+        return set()
+    return set(os.listdir('/dev/shm'))
+
+if __name__ == '__main__':
+    before = shared_segments()
+    pipeline = Pipeline(maxsize=4, discard=discard_shared)
+    pipeline.add_stage(download_image, workers=2)
+    pipeline.add_stage(SharedMemoryFunc(resize_image), workers=2,
+                       processes=True)
+    pipeline.add_stage(broken_upload)
+    pipeline.start()
+    try:
+        for _ in range(40):
+            pipeline.put(object())
+        pipeline.close()
+    except QueueClosed:
+        pass
+    try:
+        pipeline.join()
+    except ValueError as e:
+        print('join() raised %r, %d shared segments left' % (
+            e, len(shared_segments() - before)))
+"""
+> join() raised ValueError('upload failed'), 0 shared segments left
+"""
+
+
+"""
+download/resize/uploadの大半はI/O待ちなので、asyncioで1スレッドの中で
+重ねて待つこともできる。上限つきのasyncio.Queueで段階をつなぎ、
+各段階は同じ関数をそのまま使う。コルーチン関数ならそのままawaitし、
+普通の関数はブロックするものとみなしてexecutorのスレッドで実行する。
+入力の終わりは番兵をキューに流して伝える。
+"""
+import asyncio
+import inspect
+
+class AsyncPipeline(object):
+    """add_stage()で段階を追加し、run()の結果をasync forで取り出す"""
+    DONE = object() # 入力の終わりを表す番兵
+
+    def __init__(self, maxsize=10, executor=None):
+        """executorがNoneならイベントループのデフォルトのexecutorを使う"""
+        self.maxsize = maxsize
+        self.executor = executor
+        self.specs = []
+
+    def add_stage(self, func, workers=1, blocking=True):
+        """workersは段階の中で同時に処理する数。普通の関数でも
+        すぐに終わるならblocking=Falseでイベントループの中で実行する
+        """
+        self.specs.append((func, workers, blocking))
+        return self
+
+    async def _feed(self, items, out_queue):
+        if hasattr(items, '__aiter__'):
+            async for item in items:
+                await out_queue.put(item)
+        else:
+            for item in items:
+                await out_queue.put(item)
+
+    async def _work(self, func, blocking, in_queue, out_queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await in_queue.get()
+            if item is self.DONE:
+                await in_queue.put(item) # 同じ段階のほかのタスクにも伝える
+                return
+            if inspect.iscoroutinefunction(func):
+                result = await func(item)
+            elif blocking:
+                result = await loop.run_in_executor(self.executor, func, item)
+            else:
+                result = func(item)
+            await out_queue.put(result)
+
+    async def _run_stage(self, spec, in_queue, out_queue):
+        func, workers, blocking = spec
+        tasks = [asyncio.create_task(
+                     self._work(func, blocking, in_queue, out_queue))
+                 for _ in range(workers)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # 1つが失敗するか止められたら、同じ段階のほかのタスクも止める
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        # 番兵は正常に終わったときだけ送る。止められたあとに送ろうとすると、
+        # もう誰も読まない満杯のキューで待ち続ける
+        await out_queue.put(self.DONE)
+
+    async def run(self, items):
+        """itemsを流して結果を出てきた順に返す非同期ジェネレータ。
+        段階のどこかで例外が起きたら、残りを止めてから送出する。
+        途中でやめるときはcontextlib.aclosing()で閉じると、すぐに残りが止まる
+        """
+        queues = [asyncio.Queue(self.maxsize)
+                  for _ in range(len(self.specs) + 1)]
+
+        async def feed():
+            await self._feed(items, queues[0])
+            await queues[0].put(self.DONE)
+
+        def stop_on_error(task):
+            # 失敗したら結果のキューを空けて番兵を入れ、下の読み出しを終わらせる
+            if not task.cancelled() and task.exception() is not None:
+                while not queues[-1].empty():
+                    queues[-1].get_nowait()
+                queues[-1].put_nowait(self.DONE)
+
+        tasks = [asyncio.create_task(feed())]
+        for spec, in_queue, out_queue in zip(self.specs, queues, queues[1:]):
+            tasks.append(asyncio.create_task(
+                self._run_stage(spec, in_queue, out_queue)))
+        for task in tasks:
+            task.add_done_callback(stop_on_error)
+        try:
+            while True:
+                result = await queues[-1].get()
+                if result is self.DONE:
+                    break
+                yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+            outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        for outcome in outcomes:
+            if (isinstance(outcome, BaseException) and
+                    not isinstance(outcome, asyncio.CancelledError)):
+                raise outcome
+
+
+"""
+段階が例外を送出しても、読む側が途中でやめても、満杯のキューで止まらずに
+残りのタスクは止められる。例外はrun()の読み出し側に送出される
+"""
+import contextlib
+
+def fail_on_three(item):
+    if item == 3:
+        raise ValueError('Cannot resize %r' % item)
+    return item
+
+async def resize_until_error():
+    pipeline = AsyncPipeline(maxsize=2)
+    pipeline.add_stage(fail_on_three, workers=2)
+    pipeline.add_stage(upload)
+    try:
+        async for _ in pipeline.run(range(100)):
+            pass
+    except ValueError as e:
+        return e # まだ読まれていない結果は捨てられる
+
+async def take_first(count, closing):
+    pipeline = AsyncPipeline(maxsize=2)
+    pipeline.add_stage(resize, blocking=False)
+    pipeline.add_stage(upload)
+    results = pipeline.run(range(100))
+    if closing:
+        results = contextlib.aclosing(results)
+    else:
+        results = contextlib.nullcontext(results)
+    taken = []
+    async with results as stream:
+        async for result in stream:
+            await asyncio.sleep(0.01) # 遅い読み手
+            taken.append(result)
+            if len(taken) == count:
+                break
+    return taken
+
+if __name__ == '__main__':
+    print(repr(asyncio.run(asyncio.wait_for(resize_until_error(), 5))))
+    for closing in (True, False):
+        print(asyncio.run(asyncio.wait_for(take_first(3, closing), 5)))
+"""
+> ValueError('Cannot resize 3')
+> [0, 1, 2]
+> [0, 1, 2]
+
+aclosing()で閉じると段階のタスクはbreakのすぐあとに止まる。閉じなければ
+asyncio.run()が終わるときにジェネレータを閉じて止める。
+"""
+
+
+"""
+ローカルの偽のHTTPサーバを別プロセスで動かし、1リクエストごとに0.5秒待たせる。
+downloadの段階に10000個のタスクを割り当てると、1スレッドのまま
+10000個のダウンロードを同時に待てる。resizeとuploadは今までと同じ普通の関数。
+"""
+from multiprocessing import Process, Queue as ProcessQueue
+
+async def fake_http_server(port_queue, delay):
+    async def handle(reader, writer):
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        await asyncio.sleep(delay)
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Length: 5\r\n\r\nimage')
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0, backlog=4096)
+    port_queue.put(server.sockets[0].getsockname()[1])
+    async with server:
+        await server.serve_forever()
+
+def run_fake_http_server(port_queue, delay):
+    asyncio.run(fake_http_server(port_queue, delay))
+
+async def async_download(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /image HTTP/1.0\r\n\r\n')
+    response = await reader.read()
+    writer.close()
+    return response.split(b'\r\n\r\n', 1)[1]
+
+async def download_all(port, count):
+    pipeline = AsyncPipeline(maxsize=1000)
+    pipeline.add_stage(async_download, workers=count)
+    pipeline.add_stage(resize, blocking=False)
+    pipeline.add_stage(upload, workers=4)
+    return [result async for result in pipeline.run([port] * count)]
+
+if __name__ == '__main__':
+    port_queue = ProcessQueue()
+    server = Process(target=run_fake_http_server, args=(port_queue, 0.5),
+                     daemon=True)
+    server.start()
+    port = port_queue.get()
+
+    start = time.time()
+    results = asyncio.run(download_all(port, 10000))
+    end = time.time()
+    server.terminate()
+    print('Downloaded %d images in %.3f seconds' % (len(results), end - start))
+"""
+> Downloaded 10000 images in 5.802 seconds
+
+1つずつ待てば5000秒かかる。残りの時間は1コアでサーバとクライアントの
+20000個の接続を処理するCPU時間。
+"""
+
+
+"""
+キューのロックをlock_stats.InstrumentedLockに差し替えると、
+どのキューのどの行でスレッドが待たされているかがわかる
+"""
+import lock_stats
+if __name__ == '__main__':
+    queues = [BlockingQueue(maxsize, lock=lock_stats.InstrumentedLock(name))
+              for name, maxsize in (('download_queue', 10), ('resize_queue', 10),
+                                    ('done_queue', 0))]
+    threads = [
+        StoppableWorker(download, queues[0], queues[1]),
+        StoppableWorker(resize, queues[1], queues[2]),
+    ]
+    for thread in threads:
+        thread.start()
+    queues[0].put_many(object() for _ in range(10000))
+    for queue, thread in zip(queues, threads):
+        queue.close()
+        thread.join()
+    lock_stats.report(limit=5)
+
+"""
+bench.pyで、1枚の画像のresizeとuploadを直列、スレッド、プロセス、asyncioの
+それぞれで計測する。パイプライン全体もbench.run()で
+スレッドの段階とプロセスの段階を比べる
+"""
+def process_image(item):
+    return upload(len(resize_image(bytes(64 * 1024))))
+
+if __name__ == '__main__':
+    results = bench.run_modes('image', process_image, range(40), workers=4,
+                              chunksize=10, repeat=3)
+
+def run_pipeline(processes):
+    pipeline = Pipeline(maxsize=4)
+    pipeline.add_stage(download_image, workers=1)
+    pipeline.add_stage(SharedMemoryFunc(resize_image), workers=4,
+                       processes=processes)
+    pipeline.add_stage(upload_image, workers=1)
+    pipeline.start()
+    pipeline.put_many(object() for _ in range(10))
+    pipeline.close()
+    pipeline.join()
+
+if __name__ == '__main__':
+    results.append(bench.run('pipeline', 'thread', lambda: run_pipeline(False),
+                             repeat=3, workers=4))
+    results.append(bench.run('pipeline', 'process', lambda: run_pipeline(True),
+                             repeat=3, workers=4))
+    bench.report(results)
+"""
+> benchmark                mode     workers    min(s) median(s)    p90(s)    max(s)
+> image                    serial         1    0.0900    0.0915    0.0932    0.0936
+> image                    thread         4    0.0925    0.0927    0.0944    0.0949
+> image                    process        4    0.0888    0.1042    0.1052    0.1054
+> image                    asyncio        1    0.0983    0.0993    0.1051    0.1065
+> pipeline                 thread         4    0.1211    0.1252    0.1264    0.1267
+> pipeline                 process        4    0.3632    0.3664    0.3739    0.3758
+
+1コアのマシンで計測。pipelineのprocessは毎回プールを作って子プロセスを
+起動する時間も含むので、1コアでは遅くなる
+"""
@@ -0,0 +1,182 @@
+"""
+並列化の方式を比べるベンチマーク。
+
+time()を1回呼んで差を表示するだけでは、実行のたびに結果がばらつく。
+measure()はウォームアップのあとで何回か繰り返して計測し、中央値と
+パーセンタイルで比べる。run_modes()は同じ作業を直列(serial)、スレッド(thread)、
+プロセス(process)、asyncioの各方式で実行して計測する。
+結果はJSONに保存でき、保存しておいた結果(baseline)と比べて遅くなった
+ものを見つけられる。
+
+    BENCH_SAVE=base.json python3 37_thread.py
+    BENCH_BASELINE=base.json python3 37_thread.py
+    python3 bench.py new.json base.json
+"""
+import asyncio
+import inspect
+import json
+import os
+import platform
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+
+MODES = ('serial', 'thread', 'process', 'asyncio')
+
+def measure(func, warmup=1, repeat=5):
+    """funcをwarmup回実行してから、repeat回の実行時間(秒)をリストで返す"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        samples.append(perf_counter() - start)
+    return samples
+
+def percentile(samples, percent):
+    """並べ替えたsamplesを線形補間してpercentパーセンタイルを求める"""
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (
+        position - lower)
+
+def summarize(samples):
+    return {
+        'repeat': len(samples),
+        'min': min(samples),
+        'median': percentile(samples, 50),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'max': max(samples),
+        'mean': sum(samples) / len(samples),
+    }
+
+def run(name, mode, func, warmup=1, repeat=5, workers=1):
+    """funcを計測して、名前と方式と統計値の辞書を返す"""
+    result = {'name': name, 'mode': mode, 'workers': workers}
+    samples = measure(func, warmup, repeat)
+    result.update(summarize(samples))
+    result['samples'] = samples
+    return result
+
+
+def process_context():
+    """スレッドを持つ親からforkしないように、forkserver(なければspawn)を使う"""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+async def _gather(func, items):
+    """itemsのそれぞれを1つのタスクにする。コルーチン関数ならawaitし、
+    普通の関数はイベントループの中でそのまま呼ぶ
+    """
+    if inspect.iscoroutinefunction(func):
+        return await asyncio.gather(*[func(item) for item in items])
+
+    async def call(item):
+        return func(item)
+    return await asyncio.gather(*[call(item) for item in items])
+
+def run_modes(name, func, items, modes=MODES, workers=None, chunksize=1,
+              warmup=1, repeat=5):
+    """itemsのそれぞれにfuncを適用する作業をmodesの方式で計測し、
+    結果のリストを返す。processではfuncとitemsをpickleできなければならない。
+    子プロセスはforkserverから作られ、funcのあるスクリプトをimportし直すので、
+    スクリプトの例はif __name__ == '__main__':の中に置く。
+    プールは計測の外で作り、ウォームアップで子プロセスを起動しておく
+    """
+    items = list(items)
+    workers = workers or os.cpu_count()
+    results = []
+    for mode in modes:
+        if mode == 'serial':
+            results.append(run(name, mode,
+                               lambda: [func(item) for item in items],
+                               warmup, repeat, 1))
+        elif mode == 'thread':
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results.append(run(name, mode,
+                                   lambda: list(executor.map(func, items)),
+                                   warmup, repeat, workers))
+        elif mode == 'process':
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=process_context()) as executor:
+                results.append(run(name, mode, lambda: list(
+                    executor.map(func, items, chunksize=chunksize)),
+                    warmup, repeat, workers))
+        elif mode == 'asyncio':
+            results.append(run(name, mode,
+                               lambda: asyncio.run(_gather(func, items)),
+                               warmup, repeat, 1))
+        else:
+            raise ValueError('Unknown mode: %r' % mode)
+    return results
+
+
+def print_results(results, file=None):
+    print('%-24s %-8s %7s %9s %9s %9s %9s' % (
+        'benchmark', 'mode', 'workers', 'min(s)', 'median(s)', 'p90(s)',
+        'max(s)'), file=file)
+    for result in results:
+        print('%-24s %-8s %7d %9.4f %9.4f %9.4f %9.4f' % (
+            result['name'], result['mode'], result['workers'],
+            result['min'], result['median'], result['p90'], result['max']),
+            file=file)
+
+def save(results, path):
+    """結果と計測した環境をJSONで保存する"""
+    with open(path, 'w') as handle:
+        json.dump({
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'results': results,
+        }, handle, indent=2)
+
+def load(path):
+    with open(path) as handle:
+        return json.load(handle)['results']
+
+def compare(results, baseline, tolerance=0.1, file=None):
+    """resultsとbaselineの中央値を名前と方式ごとに比べて表示し、
+    tolerance(0.1なら10%)より遅くなったものをリストで返す
+    """
+    previous = {(result['name'], result['mode']): result
+                for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result['name'], result['mode']))
+        if old is None:
+            continue
+        ratio = result['median'] / old['median']
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(result)
+        print('%-24s %-8s %9.4f -> %9.4f %6.2fx%s' % (
+            result['name'], result['mode'], old['median'], result['median'],
+            ratio, '  REGRESSION' if slower else ''), file=file)
+    return regressions
+
+def report(results, save_path=None, baseline_path=None, tolerance=0.1):
+    """結果を表示する。save_pathがあれば保存し、baseline_pathがあれば比べる。
+    指定しなければ環境変数BENCH_SAVEとBENCH_BASELINEを使う
+    """
+    print_results(results)
+    save_path = save_path or os.environ.get('BENCH_SAVE')
+    baseline_path = baseline_path or os.environ.get('BENCH_BASELINE')
+    if save_path:
+        save(results, save_path)
+    if baseline_path:
+        return compare(results, load(baseline_path), tolerance)
+    return []
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python3 bench.py RESULTS.json BASELINE.json')
+    if compare(load(sys.argv[1]), load(sys.argv[2])):
+        sys.exit(1)
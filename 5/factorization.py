@@ -0,0 +1,91 @@
+"""
+約数と素因数分解。
+
+37_thread.pyのfactorize()は1からnumberまですべて割ってみるのでO(n)かかる。
+約数はかならず平方根以下のものと以上のものの組になるので、
+平方根まで調べれば全部の約数がわかる。素因数分解は小さな素数の表で割っていく。
+たくさんの数はProcessPoolExecutorでコアに分けて計算する。
+"""
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from math import isqrt
+
+def divisors(number):
+    """numberのすべての約数を小さい順に返すジェネレータ。O(sqrt(n))"""
+    large = []
+    for i in range(1, isqrt(number) + 1):
+        if number % i == 0:
+            yield i
+            if i != number // i:
+                large.append(number // i)
+    yield from reversed(large)
+
+
+# prime_factors()はこれより大きな素数の表を作らず、6k±1の数で割ってみる
+SIEVE_LIMIT = 10 ** 6
+
+_sieve_limit = 1
+_primes = []
+
+def _extend_sieve(limit):
+    """エラトステネスのふるいでlimit以下の素数を求めて覚えておく。
+    ふるい直す回数を減らすため、SIEVE_LIMITまでは少なくとも前回の2倍まで広げる
+    """
+    global _sieve_limit, _primes
+    if limit <= _sieve_limit:
+        return
+    limit = max(limit, min(2 * _sieve_limit, SIEVE_LIMIT))
+    sieve = bytearray([1]) * (limit + 1)
+    sieve[0:2] = b'\0\0'
+    for i in range(2, isqrt(limit) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit + 1, i)))
+    _primes = [i for i, is_prime in enumerate(sieve) if is_prime]
+    _sieve_limit = limit
+
+def small_primes(limit):
+    """limit以下の素数のリスト"""
+    _extend_sieve(limit)
+    return _primes[:bisect_right(_primes, limit)]
+
+def _wheel(start):
+    """start以上の6k±1の数を小さい順に返す。2と3以外の素数はみなこの形"""
+    i = start - start % 6
+    while True:
+        for candidate in (i + 1, i + 5):
+            if candidate >= start:
+                yield candidate
+        i += 6
+
+def prime_factors(number):
+    """numberの素因数を重複を含めて小さい順にリストで返す。
+    SIEVE_LIMITまでは素数の表で割り、残りは6k±1の数で割ってみるので、
+    大きな数でも表は大きくならない
+    """
+    _extend_sieve(min(isqrt(number), SIEVE_LIMIT))
+    # _extend_sieve()は_primesを先に入れ替えるので、_sieve_limitを先に読む
+    sieve_limit = _sieve_limit
+    factors = []
+    for divisor in chain(_primes, _wheel(sieve_limit + 1)):
+        if divisor * divisor > number:
+            break
+        while number % divisor == 0:
+            factors.append(divisor)
+            number //= divisor
+    if number > 1:
+        factors.append(number)
+    return factors
+
+
+def divisor_list(number):
+    """プロセスプールに渡すためのdivisors()のリスト版"""
+    return list(divisors(number))
+
+def factorize_many(numbers, max_workers=None, chunksize=64, func=divisor_list):
+    """numbersのそれぞれにfunc(デフォルトは約数のリスト)をプロセスプールで
+    適用し、結果を同じ順番のリストで返す。chunksize個ずつまとめて
+    子プロセスに送るので、小さな数がたくさんあってもやりとりが少ない
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, numbers, chunksize=chunksize))
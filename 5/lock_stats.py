@@ -0,0 +1,136 @@
+"""
+ロックの待ち時間を計測する。
+
+InstrumentedLockはthreading.Lockの代わりに使えるロックで、ロックを取った
+呼び出し元(ファイル名と行番号)ごとに、取得回数、待たされた回数、待ち時間の
+合計と最大、保持時間の合計と最大を記録する。
+呼び出し元の記録はロックを取る前に探し、呼び出した命令ごとに覚えておく。
+ロックを持っている間に行うのはperf_counter()と記録の数値の更新だけで、
+その更新はロックを持っている間だけ行うので記録用のロックはいらない。
+それでもwithの1回あたり約0.7マイクロ秒余計にかかり、38_lock.pyのように
+ロックの中がごく短い処理では全体が約4倍遅くなる。待ち時間の割合を調べる
+道具であり、差し替えたまま速さを測ってはいけない。
+"""
+import os
+import sys
+import threading
+from threading import Lock
+from time import perf_counter
+from weakref import WeakSet
+
+_locks = WeakSet()
+_THREADING_FILE = threading.__file__
+
+class InstrumentedLock(object):
+    def __init__(self, name=None):
+        self.name = name or 'lock-%x' % id(self)
+        self.sites = {}
+        self._site_stats = {} # (コード, 命令の位置) -> sitesの中の記録
+        self._lock = Lock()
+        self._site = None
+        self._acquired_at = 0.0
+        _locks.add(self)
+
+    def _stats(self, frame):
+        """frameが呼び出し元の記録。ロックを取る前に呼ぶ"""
+        # f_linenoは毎回計算されて遅いので、命令の位置のf_lastiで覚えておく
+        key = (frame.f_code, frame.f_lasti)
+        stats = self._site_stats.get(key)
+        if stats is not None:
+            return stats
+        # Conditionから呼ばれたときは、Conditionを使った側を呼び出し元にする。
+        # threading.pyの中の行は使う側ごとに違うので覚えない
+        while (frame.f_code.co_filename == _THREADING_FILE and
+               frame.f_back is not None):
+            frame = frame.f_back
+        site = (frame.f_code.co_filename, frame.f_lineno)
+        # 取得回数、待たされた回数、待ち時間の合計と最大、保持時間の合計と最大
+        stats = self.sites.setdefault(site, [0, 0, 0.0, 0.0, 0.0, 0.0])
+        if key[0].co_filename != _THREADING_FILE:
+            self._site_stats[key] = stats
+        return stats
+
+    def acquire(self, blocking=True, timeout=-1):
+        stats = self._stats(sys._getframe(1))
+        if not self._lock.acquire(False):
+            if not blocking:
+                return False
+            begin = perf_counter()
+            if not self._lock.acquire(True, timeout):
+                return False
+            self._waited(stats, perf_counter() - begin)
+        stats[0] += 1
+        self._site = stats
+        self._acquired_at = perf_counter()
+        return True
+
+    @staticmethod
+    def _waited(stats, waited):
+        stats[1] += 1
+        stats[2] += waited
+        if waited > stats[3]:
+            stats[3] = waited
+
+    def release(self):
+        held = perf_counter() - self._acquired_at
+        stats = self._site
+        if stats is not None:
+            stats[4] += held
+            if held > stats[5]:
+                stats[5] = held
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    # withはacquire()とrelease()を呼ばずに同じことをして、呼び出しを1回ずつ減らす
+    def __enter__(self):
+        stats = self._stats(sys._getframe(1))
+        if not self._lock.acquire(False):
+            begin = perf_counter()
+            self._lock.acquire()
+            self._waited(stats, perf_counter() - begin)
+        stats[0] += 1
+        self._site = stats
+        self._acquired_at = perf_counter()
+        return True
+
+    def __exit__(self, *exc_info):
+        held = perf_counter() - self._acquired_at
+        stats = self._site
+        stats[4] += held
+        if held > stats[5]:
+            stats[5] = held
+        self._lock.release()
+
+    def snapshot(self):
+        """呼び出し元ごとの記録を辞書のリストで返す"""
+        return [{
+            'lock': self.name,
+            'site': '%s:%d' % (os.path.basename(site[0]), site[1]),
+            'acquisitions': stats[0],
+            'contended': stats[1],
+            'wait_seconds': stats[2],
+            'max_wait_seconds': stats[3],
+            'hold_seconds': stats[4],
+            'max_hold_seconds': stats[5],
+        } for site, stats in list(self.sites.items())
+            if stats[0]] # 取れなかったacquire(False)だけの呼び出し元は除く
+
+
+def report(file=None, limit=10):
+    """すべてのInstrumentedLockの記録を待ち時間の合計が長い順に表示し、
+    表示した記録のリストを返す
+    """
+    rows = [row for lock in list(_locks) for row in lock.snapshot()]
+    rows.sort(key=lambda row: row['wait_seconds'], reverse=True)
+    rows = rows[:limit]
+    print('%-24s %-28s %8s %8s %9s %9s %9s' % (
+        'lock', 'site', 'acquired', 'waited', 'wait(s)', 'max(ms)',
+        'hold(s)'), file=file)
+    for row in rows:
+        print('%-24s %-28s %8d %8d %9.3f %9.3f %9.3f' % (
+            row['lock'], row['site'], row['acquisitions'],
+            row['contended'], row['wait_seconds'],
+            row['max_wait_seconds'] * 1000, row['hold_seconds']), file=file)
+    return rows